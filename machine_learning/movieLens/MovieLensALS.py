@@ -7,11 +7,14 @@ from math import sqrt
 from operator import add
 from os.path import join, isfile, dirname
 
+import numpy as np
 from pyspark import SparkConf, SparkContext
 from pyspark.mllib.recommendation import ALS
 from pyspark.mllib.evaluation import MulticlassMetrics as metric
 
 from machine_learning.movieLens.MovieLens_spark_hcf import spark_inference
+from machine_learning.movieLens.recommend import rated_bitset, recommend, top_k, unpack_rated
+from machine_learning.movieLens.spark_eval import local_factors
 
 
 def parse_rating(line):
@@ -38,7 +41,7 @@ def load_ratings(ratingsFile):
         print("File %s does not exist." % ratingsFile)
         sys.exit(1)
     f = open(ratingsFile, 'r')
-    ratings = filter(lambda r: r[2] > 0, [parse_rating(line)[1] for line in f])
+    ratings = [r for r in (parse_rating(line)[1] for line in f) if r[2] > 0]
     f.close()
     if not ratings:
         print("No ratings provided.")
@@ -58,6 +61,67 @@ def compute_rmse(model, data, n):
     return sqrt(predictions_and_ratings.map(lambda x: (x[0] - x[1]) ** 2).reduce(add) / float(n))
 
 
+def rated_bits_rdd(ratings, n_users, n_items):
+    """
+    :param ratings: RDD of (userId, movieId, rating)
+    :return: rated_bitset of every (user, movie) pair, built from columnar partition chunks
+    """
+    def pairs(rows):
+        rows = np.asarray([(r[0], r[1]) for r in rows], dtype=np.int64).reshape(-1, 2)
+        yield rows
+
+    chunks = ratings.mapPartitions(pairs).collect()
+    rows = np.concatenate(chunks) if chunks else np.zeros((0, 2), dtype=np.int64)
+    return rated_bitset(rows[:, 0], rows[:, 1], n_users, n_items)
+
+
+def recommend_for_users(model, users, k, rated_bits=None, n_users=None, n_items=None):
+    """
+    Batch top-K for many users: factors come to the driver once, every batch of users is one matrix product
+    :return: items [len(users), k], scores [len(users), k]
+    """
+    user_factors, _ = local_factors(model.userFeatures(), model.rank, n_users)
+    item_factors, item_known = local_factors(model.productFeatures(), model.rank, n_items)
+    return recommend(user_factors, item_factors, users, k, rated_bits, candidates=item_known)
+
+
+def recommend_all_users(sc, model, k, rated_bits=None, n_items=None):
+    """
+    Distributed batch top-K: item factors and the rated bitset are broadcast, each partition of user
+    factors scores its own users
+    :return: RDD of (user, items [k], scores [k])
+    """
+    item_factors, item_known = local_factors(model.productFeatures(), model.rank, n_items)
+    items_bc = sc.broadcast((item_factors, item_known, rated_bits))
+
+    def score(rows):
+        rows = list(rows)
+        if not rows:
+            return
+        item_factors, item_known, bits = items_bc.value
+        users = np.asarray([row[0] for row in rows], dtype=np.int64)
+        user_factors = np.asarray([row[1] for row in rows], dtype=np.float32)
+        scores = user_factors @ item_factors.T
+        scores[:, ~item_known] = -np.inf
+        if bits is not None:
+            scores[unpack_rated(bits[users], item_factors.shape[0])] = -np.inf
+        top_items, top_scores = top_k(scores, k)
+        for u, i, v in zip(users.tolist(), top_items, top_scores):
+            yield u, i, v
+
+    return model.userFeatures().mapPartitions(score)
+
+
+def recommend_products(model, user, k, rated_items):
+    """
+    Single user through model.recommendProducts, asking for enough extra items to drop the rated ones
+    :return: list of Rating, best first
+    """
+    rated_items = set(rated_items)
+    recommendations = model.recommendProducts(user, k + len(rated_items))
+    return [r for r in recommendations if r.product not in rated_items][:k]
+
+
 def main():
     # set up environment
     conf = SparkConf() \
@@ -156,14 +220,17 @@ def main():
 
     # make personalized recommendations
 
-    my_rated_movie_ids = set([x[1] for x in my_ratings])
-    candidates = sc.parallelize([m for m in movies if m not in my_rated_movie_ids])
-    predictions = best_model.predictAll(candidates.map(lambda x: (0, x))).collect()
-    recommendations = sorted(predictions, key=lambda x: x[2], reverse=True)[:50]
-
-    print("Movies recommended for you:")
-    for i in range(len(recommendations)):
-        print("%2d: %s" % (i + 1, movies[recommendations[i][1]])).encode('ascii', 'ignore')
+    my_ratings = np.asarray(my_ratings, dtype=np.float64)
+    my_users = np.unique(my_ratings[:, 0]).astype(np.int64)
+    n_users = int(max(my_users.max(), ratings.values().map(lambda r: r[0]).max())) + 1
+    n_items = max(movies) + 1
+    rated_bits = rated_bits_rdd(training.union(my_ratings_rdd), n_users, n_items)
+    recommendations, _ = recommend_for_users(best_model, my_users, 50, rated_bits, n_users, n_items)
+
+    print("Movies recommended for user %d:" % my_users[0])
+    for i, movie in enumerate(recommendations[0]):
+        if movie in movies:
+            print("%2d: %s" % (i + 1, movies[movie].encode('ascii', 'ignore').decode()))
 
     # clean up
     sc.stop()
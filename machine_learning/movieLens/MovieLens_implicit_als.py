@@ -0,0 +1,67 @@
+"""
+implicit-feedback HCF, numpy only: als.implicit_als_fit on the observed cells O
+    1. confidence of an observed cell is 1 + alpha * (x + beta * y) (als.hcf_confidence), unobserved cells are 0
+    2. preference scores w * h are evaluated on the held-out cells of the time split, same AUC as the T models
+    3. grid over rank, lambda and alpha
+"""
+import sys
+import os
+import itertools
+from time import time
+
+from sklearn.metrics import roc_auc_score
+
+
+def add_path(path):
+    if path not in sys.path:
+        print('Adding {}'.format(path))
+        sys.path.append(path)
+
+
+abs_current_path = os.path.realpath('./')
+root_path = os.path.join('/', *abs_current_path.split(os.path.sep)[:-2])
+add_path(root_path)
+
+from machine_learning.movieLens.als import hcf_confidence, implicit_als_fit, implicit_scores
+from machine_learning.movieLens.cross_validation import prepare_holdout
+from machine_learning.movieLens.MovieLens_sklearn_hcf_nn import split_ratings_by_time
+from machine_learning.movieLens.utils import load_ratings
+
+
+def implicit_inference(fold, w, h):
+    """
+    :return: AUC of the preference scores on the fold's test cells
+    """
+    return roc_auc_score(fold['y_true'], implicit_scores(w, h, fold['test_user'], fold['test_item']))
+
+
+def main():
+    path = '../../data/movielens/medium/ratings.dat'
+    ratings = load_ratings(path)
+    training, test = split_ratings_by_time(ratings, 0.8)
+    fold = prepare_holdout(training, test, (6041, 3953))
+    r = hcf_confidence(fold['x_train'], fold['z_train'], fold['fill'], beta=0.2)
+
+    ranks = [16, 25]
+    lambdas = [0.01, 0.1]
+    alphas = [1.0, 10.0, 40.0]
+    n_iter = 10
+    best_auc = float("-inf")
+    best_config = None
+
+    for rank, lmbda, alpha in itertools.product(ranks, lambdas, alphas):
+        start_time = time()
+        w, h = implicit_als_fit(r, rank, n_iter, lmbda, alpha)
+        auc = implicit_inference(fold, w, h)
+        print("implicit ALS with rank = {}, lambda = {}, alpha = {}: AUC {:.4f}, {:.1f}s".format(
+            rank, lmbda, alpha, auc, time() - start_time))
+        if auc > best_auc:
+            best_auc = auc
+            best_config = (rank, lmbda, alpha)
+
+    print("The best implicit model was trained with rank = {}, lambda = {}, alpha = {}, and its AUC is {}".format(
+        *best_config, best_auc))
+
+
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,7 @@ from machine_learning.movieLens.MovieLens_spark_hcf import generate_xoy, generat
     sigmoid, load_ratings
 from machine_learning.movieLens.MovieLens_sklearn_hcf import mf_sklearn, split_ratings_by_time
 from machine_learning.movieLens.MovieLens_sklearn_hcf2vcat import diversity, diversity_excludes_train
+from machine_learning.movieLens.item_similarity import ItemSimilarity
 
 
 def normalize_s(x_train):
@@ -118,7 +119,7 @@ def main():
 
     for rank, num_iter in itertools.product(ranks, num_iters):
         s_hat = mf_sklearn(s, n_components=rank, n_iter=num_iter)  # [0, 23447]
-        diversity_score = diversity_excludes_train(np.dot(s_hat.T, s_hat), s_hat, o_train, x_train)
+        diversity_score = diversity_excludes_train(ItemSimilarity.from_factors(s_hat), s_hat, o_train, x_train)
         valid_auc = baseline2_inference(s_hat, test, (6041, 3953), pr_curve_filename)
         print("The current model was trained with rank = {}, and num_iter = {}, and its AUC on the "
               "validation set is {}.".format(rank, num_iter, valid_auc))
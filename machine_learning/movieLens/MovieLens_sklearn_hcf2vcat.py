@@ -29,6 +29,8 @@ add_path(root_path)
 
 from machine_learning.movieLens.MovieLens_sklearn_hcf_nn import split_ratings_by_time
 from machine_learning.movieLens.utils import generate_xoy, generate_xoy_binary, load_ratings
+from machine_learning.movieLens.recommend import top_k_dense
+from machine_learning.movieLens.item_similarity import ItemSimilarity, DenseSimilarity
 
 
 def mf_sklearn(t, n_components, n_iter):
@@ -79,21 +81,27 @@ def diversity(sim_matrix, r_hat):
     return diversity_score
 
 
-def diversity_excludes_train(sim_matrix, r_hat, o_train, x_train):
-    mask = sim_matrix > 0
-    sim_matrix = (sim_matrix - np.min(sim_matrix[mask])) / (np.max(sim_matrix[mask]) - np.min(sim_matrix[mask]))
-    sim_matrix *= mask
-    div_matrix = 1 - sim_matrix
-    r_hat = r_hat * (o_train < 1)  # f1: must have
+def similarity_index(sim):
+    """
+    :param sim: ItemSimilarity / DenseSimilarity, or a dense sim_matrix, which keeps the old dense div_matrix
+                semantics (min-max over the whole matrix, directional div[a, b], every pair)
+    """
+    return sim if isinstance(sim, (ItemSimilarity, DenseSimilarity)) else DenseSimilarity(sim)
 
+
+def diversity_excludes_train(sim, r_hat, o_train, x_train):
+    """
+    :param sim: ItemSimilarity (build it once per model) or a dense sim_matrix, see similarity_index
+    """
+    sim_index = similarity_index(sim)
     k = 50
+    topk_all, _ = top_k_dense(r_hat, k, seen=o_train > 0)  # f1: must have, training items are never returned
     all_users_div = []
-    for i, row in enumerate(r_hat):
+    for i, topk_indices in enumerate(topk_all):
         # if np.max(x_train[i]) < 0.5:  # f2: user must have positive rating in x_train (optional)
         #     continue
 
-        topk_indices = row.argsort()[-k:][::-1]
-        topk_diversity = get_user_div_list(div_matrix, topk_indices)
+        topk_diversity = get_user_div_list(sim_index, topk_indices)
         all_users_div.append(np.mean(topk_diversity))
 
     avg_div = sum(all_users_div) / len(all_users_div)
@@ -108,37 +116,33 @@ def diversity_excludes_train(sim_matrix, r_hat, o_train, x_train):
     return avg_div
 
 
-def get_user_div_list(div_matrix, topk_indices):
-    comb = np.array(list(combinations(topk_indices, 2)))
-    topk_diversity = div_matrix[comb[:, 0], comb[:, 1]]
+def get_user_div_list(sim_index, topk_indices):
+    topk_indices = np.asarray(topk_indices)
+    first, second = np.triu_indices(topk_indices.shape[0], 1)  # same pairs as combinations(topk_indices, 2)
+    topk_diversity = sim_index.dissimilarity(topk_indices[first], topk_indices[second])
     return topk_diversity
 
 
-def diversity_rerank(sim_matrix, r_hat, o_train, x_train):
+def diversity_rerank(sim, r_hat, o_train, x_train):
     # rerank by largest diversity among topk R*
-    mask = sim_matrix > 0
-    sim_matrix = (sim_matrix - np.min(sim_matrix[mask])) / (np.max(sim_matrix[mask]) - np.min(sim_matrix[mask]))
-    sim_matrix *= mask
-    div_matrix = 1 - sim_matrix
-    r_hat = r_hat * (o_train < 1)  # f1: must have
-
+    sim_index = similarity_index(sim)
     k = 50
     topk2 = 9
+    topk_all, _ = top_k_dense(r_hat, k, seen=o_train > 0)  # f1: must have, training items are never returned
     all_users_div = []
-    for i, row in enumerate(r_hat):  # for each user
+    for topk_indices in topk_all:  # for each user
         # if np.max(x_train[i]) < 0.5:  # f2: user must have positive rating in x_train (optional)
         #     continue
 
         div_idx_list = []
-        topk_indices = row.argsort()[-k:][::-1]
         div_idx_list.append(topk_indices[0])
         topk_indices = np.delete(topk_indices, 0)  # delete by index
         for i in range(topk2):
-            candidate_idx = select_largest_div(div_idx_list, div_matrix, topk_indices)
+            candidate_idx = select_largest_div(div_idx_list, sim_index, topk_indices)
             div_idx_list.append(topk_indices[candidate_idx])
             topk_indices = np.delete(topk_indices, candidate_idx)
 
-        user_div_list = get_user_div_list(div_matrix, div_idx_list)
+        user_div_list = get_user_div_list(sim_index, div_idx_list)
         all_users_div.append(np.mean(user_div_list))
 
     avg_div = sum(all_users_div) / len(all_users_div)
@@ -153,17 +157,10 @@ def diversity_rerank(sim_matrix, r_hat, o_train, x_train):
     return avg_div
 
 
-def select_largest_div(div_list, div_matrix, topk_indices):
-    largest_avg_div = float('-inf')
-    candidate_idx = -1
-    for i, idx in enumerate(topk_indices):  # for topk item indices
-        candidate_div_list = div_matrix[div_list, idx]
-        avg_div = np.mean(candidate_div_list)
-        if avg_div > largest_avg_div:
-            candidate_idx = i
-            largest_avg_div = avg_div
-
-    return candidate_idx
+def select_largest_div(div_list, sim_index, topk_indices):
+    # candidate with the largest mean dissimilarity to the already selected items, first one on ties
+    div = sim_index.dissimilarity(np.tile(div_list, len(topk_indices)), np.repeat(topk_indices, len(div_list)))
+    return int(np.argmax(div.reshape(len(topk_indices), len(div_list)).mean(axis=1)))
 
 
 def hcf_inference(t_hat, training, test, rating_shape, pr_curve_filename):
@@ -215,7 +212,8 @@ def main():
         t_hat = mf_sklearn(t, n_components=rank, n_iter=num_iter)
 
         valid_auc, t1_hat_norm, r_hat = hcf_inference(t_hat, training, test, (6041, 3953), pr_curve_filename)
-        diversity_score = diversity_excludes_train(np.dot(t1_hat_norm.T, t1_hat_norm), r_hat, o_train, x_train)
+        sim_index = ItemSimilarity.from_factors(t1_hat_norm)  # top-N of t1_hat_norm.T * t1_hat_norm, built blockwise
+        diversity_score = diversity_excludes_train(sim_index, r_hat, o_train, x_train)
         print("The current model was trained with rank = {}, and num_iter = {}, and its AUC on the "
               "validation set is {}.".format(rank, num_iter, valid_auc))
         if valid_auc > best_validation_auc:
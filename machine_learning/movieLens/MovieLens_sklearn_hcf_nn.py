@@ -11,6 +11,7 @@ import itertools
 from tqdm import tqdm
 import random
 import pickle
+from time import time
 import torch
 import torch.nn.functional as F
 from torch.utils.data import TensorDataset, DataLoader
@@ -31,8 +32,11 @@ abs_current_path = os.path.realpath('./')
 root_path = os.path.join('/', *abs_current_path.split(os.path.sep)[:-2])
 add_path(root_path)
 
-from machine_learning.movieLens.hcf_nn import Hcf
+from machine_learning.movieLens.hcf_nn import Hcf, HcfEmbedding
+from machine_learning.movieLens.hcf_data import ObservedBatches, ObservedBagBatches, gather_bags, make_loader, \
+    observed_tensors, rating_bags
 from machine_learning.movieLens.utils import generate_xoy, generate_xoy_binary, load_ratings
+from machine_learning.movieLens.splits import mod_split, time_split, take
 
 
 def split_ratings(ratings, b1):
@@ -41,12 +45,8 @@ def split_ratings(ratings, b1):
     :param b1: boundary1: between training and validation
     :return: training, test: [i, j, rating]
     """
-    training = np.array([row for row in ratings if row[3] % 10 < b1])  # [0, 5]
-    test = np.array([row for row in ratings if b1 <= row[3] % 10])  # [8, 9]
-    training = np.delete(training, 3, 1)
-    test = np.delete(test, 3, 1)
-
-    return training, test
+    train_idx, test_idx = mod_split(ratings[:, 3], b1)  # [0, b1), [b1, 9]
+    return take(ratings, train_idx), take(ratings, test_idx)
 
 
 def split_ratings_by_time(ratings, b1):
@@ -55,14 +55,8 @@ def split_ratings_by_time(ratings, b1):
     :param b1: boundary1: between training and validation
     :return: training, test: [i, j, rating]
     """
-    time_order = ratings[:, 3].argsort()
-    new_ratings = ratings[time_order]
-    training = new_ratings[:int(new_ratings.shape[0] * b1)]
-    test = new_ratings[int(new_ratings.shape[0] * b1):]
-    training = np.delete(training, 3, 1)
-    test = np.delete(test, 3, 1)
-
-    return training, test
+    train_idx, test_idx = time_split(ratings[:, 3], b1)
+    return take(ratings, train_idx), take(ratings, test_idx)
 
 
 def mf_sklearn(t, n_components, n_iter):
@@ -120,26 +114,41 @@ def build_dataset(uv_file):
     print(y_sample)
 
 
-def hcf_nn_inference(net, uv_file, device):
+def hcf_nn_scores(net, u, v, pairs, device, batch_size=65536):
+    """
+    Batched forward pass over (user, item) pairs, no autograd, scores written into one preallocated array
+    :param pairs: [n, 2] user and item index of each pair
+    :return: [n] float32, the network's positive-rating output
+    """
     net.eval()
+    dtype = next(net.parameters()).dtype
+    pairs = np.asarray(pairs)
+    users = torch.from_numpy(pairs[:, 0].astype(np.int64)).to(device)
+    items = torch.from_numpy(pairs[:, 1].astype(np.int64)).to(device)
+    u_table = torch.as_tensor(u, dtype=dtype, device=device)
+    v_table = torch.as_tensor(v, dtype=dtype, device=device)
+    y_hat = np.empty(pairs.shape[0], dtype=np.float32)
+    out = torch.from_numpy(y_hat)
+    u_batch = torch.empty((min(batch_size, pairs.shape[0]), u_table.shape[1]), dtype=dtype, device=device)
+    v_batch = torch.empty((min(batch_size, pairs.shape[0]), v_table.shape[1]), dtype=dtype, device=device)
+    with torch.inference_mode():
+        for lo in range(0, pairs.shape[0], batch_size):
+            hi = min(lo + batch_size, pairs.shape[0])
+            torch.index_select(u_table, 0, users[lo:hi], out=u_batch[:hi - lo])
+            torch.index_select(v_table, 0, items[lo:hi], out=v_batch[:hi - lo])
+            out[lo:hi] = net(u_batch[:hi - lo], v_batch[:hi - lo])[:, 0].cpu()
+    return y_hat
+
+
+def hcf_nn_inference(net, uv_file, device, batch_size=65536):
     u, v, x, _, y = np.load(uv_file, allow_pickle=True)
     path = '../../data/movielens/medium/ratings.dat'
     ratings = load_ratings(path)
     training, test = split_ratings(ratings, 8)
     x_test, o_test, y_test = generate_xoy_binary(test, (6041, 3953))
-    # o_list = dense_to_sparse(o_test)
-    # np.save('test_o_list.npy', o_list)
-    o_list = np.load('test_o_list.npy')
+    o_list = np.argwhere(o_test > 0)  # row-major, same order as x_test[o_test > 0]
     y_true = x_test[o_test > 0]
-    y_hat = np.zeros(y_true.shape)
-    for i, row in enumerate(o_list):
-        i_index = int(row[0])
-        j_index = int(row[1])
-        u_vec = torch.from_numpy(u[i_index]).unsqueeze(0).to(device)
-        v_vec = torch.from_numpy(v[j_index]).unsqueeze(0).to(device)
-
-        rating_hat = net(u_vec, v_vec)
-        y_hat[i] = rating_hat.squeeze(0).cpu().detach().numpy()[0]
+    y_hat = hcf_nn_scores(net, u, v, o_list, device, batch_size)
 
     auc_score = roc_auc_score(y_true, y_hat)
     precision, recall, thresholds = precision_recall_curve(y_true, y_hat)
@@ -167,6 +176,67 @@ def hcf_inference(t_hat, training, test, rating_shape, pr_curve_filename):
     return auc_score
 
 
+def nmf_embedding_init(t, n_components, n_iter):
+    """
+    Factors of get_u_v_label without the dense u = x * p, y * r
+    :return: p, r [n_items, n_components] bag weights, v [n_items, 2 * n_components] item vectors
+    """
+    split = int(len(t) / 2)
+    model = NMF(n_components=n_components, init='random', random_state=0, max_iter=n_iter)
+    p = model.fit_transform(t[:split])
+    q = model.components_
+    r = model.fit_transform(t[split:])
+    s = model.components_
+    return p, r, np.concatenate((q, s), axis=0).T
+
+
+def hcf_embedding_scores(net, bags, pairs, device, batch_size=65536):
+    """
+    hcf_nn_scores for HcfEmbedding, user vectors are built once from the rating bags
+    :return: [n] float32
+    """
+    net.eval()
+    n_users = bags[0].shape[0] - 1
+    pairs = np.asarray(pairs)
+    y_hat = np.empty(pairs.shape[0], dtype=np.float32)
+    out = torch.from_numpy(y_hat)
+    with torch.inference_mode():
+        inputs = [t.to(device) for t in gather_bags(*bags, np.arange(n_users))]
+        u_table = net.user_vectors(*inputs)
+        users = torch.from_numpy(pairs[:, 0].astype(np.int64)).to(device)
+        items = torch.from_numpy(pairs[:, 1].astype(np.int64)).to(device)
+        for lo in range(0, pairs.shape[0], batch_size):
+            hi = min(lo + batch_size, pairs.shape[0])
+            v = net.item_embedding(items[lo:hi])
+            out[lo:hi] = super(HcfEmbedding, net).forward(u_table[users[lo:hi]], v)[:, 0].cpu()
+    return y_hat
+
+
+def train_hcf(net, optimizer, dataset, loader, n_epochs, device, verbose=True):
+    """
+    MSE on (x, y) labels of observed cells, one pass over the cells per epoch
+    """
+    net.train()
+    for epoch in range(n_epochs):
+        dataset.set_epoch(epoch)
+        start_time = time()
+        n_samples = 0
+        total_loss = 0.
+        for batch in loader:
+            *inputs, label = [t.to(device) for t in batch]  # (u, v) for Hcf, bags and items for HcfEmbedding
+            optimizer.zero_grad()
+            rating_hat = net(*inputs)
+            loss = F.mse_loss(rating_hat, label)
+            loss.backward()
+            optimizer.step()
+            n_samples += label.shape[0]
+            total_loss += loss.item() * label.shape[0]
+        seconds = time() - start_time
+        if verbose:
+            print('epoch {}: loss {:.5f}, {:.0f} samples/s'.format(
+                epoch, total_loss / max(n_samples, 1), n_samples / seconds))
+
+
 def main():
     rank = 25
     num_iter = 2000
@@ -179,34 +249,49 @@ def main():
     uv_file = 'uv_25.npy'
     u, v, x, o_list, y = np.load(uv_file, allow_pickle=True)
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    batch_size = 50
+    batch_size = 4096
+    n_epochs = 5
+    num_workers = 2
     lr = 1e-3
 
+    users, items, labels = observed_tensors(o_list, x, y)
+    dataset = ObservedBatches(users, items, labels, u, v, batch_size)
+    loader = make_loader(dataset, num_workers)
     net = Hcf(in_feature=rank*2).to(device)
     optimizer = torch.optim.Adam(net.parameters(), lr=lr)
-    net.train()
-
-    for i in range(num_iter):
-        # sample_index = o_list[np.random.choice(len(o_list), size=batch_size, replace=False)]
-        sample_index = random.sample(o_list, batch_size)
-        i_index = [x[0] for x in sample_index]
-        j_index = [x[1] for x in sample_index]
-        u_sample = torch.from_numpy(u[i_index]).to(device)
-        v_sample = torch.from_numpy(v[j_index]).to(device)
-        x_sample = x[i_index, j_index]
-        y_sample = y[i_index, j_index]
-        label = torch.from_numpy(np.array((x_sample, y_sample)).T).to(device)
-        optimizer.zero_grad()
-
-        rating_hat = net(u_sample, v_sample)
-        loss = F.mse_loss(rating_hat, label)
-        loss.backward()
-        optimizer.step()
+    train_hcf(net, optimizer, dataset, loader, n_epochs, device)
+    torch.save(net.state_dict(), 'hcf_{}.pt'.format(rank))  # hcf_export.py
 
     auc_score = hcf_nn_inference(net, uv_file, device)
     print('auc score: {}'.format(auc_score))
 
 
+def main_embedding():
+    """
+    HcfEmbedding: trained from the sparse training ratings, no dense x / y / u tables
+    """
+    # cross_validation imports this module through MovieLens_sklearn_hcf2vcat
+    from machine_learning.movieLens.cross_validation import prepare_holdout
+
+    rank = 25
+    path = '../../data/movielens/medium/ratings.dat'
+    ratings = load_ratings(path)
+    training, test = split_ratings(ratings, 8)
+    fold = prepare_holdout(training, test, (6041, 3953))
+    p, r, v = nmf_embedding_init(fold['t'], rank, 200)
+    bags = rating_bags(fold['x_train'], fold['z_train'])
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    dataset = ObservedBagBatches(bags, fold['fill'], batch_size=4096)
+    net = HcfEmbedding(p, r, v, fill=fold['fill']).to(device)
+    optimizer = torch.optim.Adam(net.parameters(), lr=1e-3)
+    train_hcf(net, optimizer, dataset, make_loader(dataset, num_workers=2), 5, device)
+
+    pairs = np.stack((fold['test_user'], fold['test_item']), axis=1)
+    y_hat = hcf_embedding_scores(net, bags, pairs, device)
+    print('auc score: {}'.format(roc_auc_score(fold['y_true'], y_hat)))
+
+
 if __name__ == "__main__":
     main()
     # uv_file = 'uv_16.npy'
@@ -4,6 +4,8 @@
 use numpy to process matrices
     1. use sklearn's MF (done)
     2. stuck at line 195: model = ALS.train(t_rdd, rank, numIter, lmbda)
+    3. python MovieLens_spark_base1.py distributed: s_hat is scored and written by the executors, the validation AUC
+       is computed in factored form (distributed_inference), no dense matrix on the driver and no diversity
 """
 import itertools
 import os
@@ -16,7 +18,7 @@ import numpy as np
 import tqdm
 from sklearn.metrics import roc_auc_score, precision_recall_curve
 from pyspark.mllib.evaluation import BinaryClassificationMetrics
-from pyspark.mllib.recommendation import ALS, Rating
+from pyspark.mllib.recommendation import Rating
 from pyspark.sql import SparkSession
 from scipy.sparse import coo_matrix
 import matplotlib.pyplot as plt
@@ -36,6 +38,10 @@ from machine_learning.movieLens.MovieLens_spark_hcf import spark_matrix_completi
 from machine_learning.movieLens.MovieLens_sklearn_hcf_nn import split_ratings_by_time
 from machine_learning.movieLens.MovieLens_sklearn_hcf2vcat import diversity_excludes_train, diversity_rerank
 from machine_learning.movieLens.utils import load_ratings, generate_xoy, generate_xoy_binary
+from machine_learning.movieLens.spark_io import dense_to_triples, default_num_partitions, triples_to_dataframe, \
+    triples_to_parquet, read_triples_parquet, als_ml_fit, export_factors_and_scores
+from machine_learning.movieLens.cross_validation import build_xoz
+from machine_learning.movieLens.spark_eval import broadcast_scores_and_labels
 
 
 def compute_s(x_train):
@@ -96,6 +102,27 @@ def get_list_tuples():
     return s_list_tuple, test_list_tuple, o_train, x_train
 
 
+def get_triples():
+    """
+    Same data as get_list_tuples, kept as numpy (rows, cols, values) arrays for spark_io
+    """
+    npz_file = 'base1.npz'
+    path = '../../data/movielens/medium/ratings.dat'
+    ratings = load_ratings(path)  # [i, j, rating, timestamp]
+    training, test = split_ratings_by_time(ratings, 0.8)  # (i, j, value)
+    x_train, o_train, y_train = generate_xoy(training, (6041, 3953))
+    if not os.path.isfile(npz_file):
+        s = compute_s(x_train)
+        rows, cols, values = dense_to_triples(s, 1e-2)
+        np.savez(npz_file, rows=rows, cols=cols, values=values)
+    else:
+        s_file = np.load(npz_file)
+        rows, cols, values = s_file['rows'], s_file['cols'], s_file['values']
+
+    test = normalize_validation(test)
+    return (rows, cols, values), test, o_train, x_train
+
+
 def manual_inference(s_hat):
     path = '../../data/movielens/medium/ratings.dat'
     ratings = load_ratings(path)  # [i, j, rating, timestamp]
@@ -118,16 +145,37 @@ def manual_inference(s_hat):
     return auc_score, all_scores_norm
 
 
-def spark_inference(model, data):
+def distributed_inference(sc, model, rank, out_dir):
+    """
+    manual_inference without s_hat on the driver: export_factors_and_scores writes w, h and s_hat under out_dir,
+    x * s_hat = (x * w) * h.T is scored on the validation cells from [n, rank] factors
+    :return: auc
+    """
+    path = '../../data/movielens/medium/ratings.dat'
+    ratings = load_ratings(path)  # [i, j, rating, timestamp]
+    training, test = split_ratings_by_time(ratings, 0.8)
+    w, h = export_factors_and_scores(sc, model, 3953, 3953, rank, out_dir)
+    x, _, _ = build_xoz(training, (6041, 3953))  # the x of generate_xoy
+    user_factors = x @ w
+    user, item = test[:, 0].astype(np.int64), test[:, 1].astype(np.int64)
+    y_scores = np.einsum('ij,ij->i', user_factors[user], h[item])
+    return roc_auc_score(test[:, 2] >= 3, y_scores)  # generate_xoy_binary
+
+
+def spark_inference(model, data, shuffle_join=False):
     """
     :param model:
     :param data:
+    :param shuffle_join: score with predictAll + join (two shuffles) instead of broadcast factors
     :return:
     """
-    predictions = model.predictAll(data.map(lambda x: (x[0], x[1])))
-    predictions_and_ratings = predictions.map(lambda x: ((x[0], x[1]), x[2])) \
-        .join(data.map(lambda x: ((x[0], x[1]), x[2]))) \
-        .values()
+    if shuffle_join:
+        predictions = model.predictAll(data.map(lambda x: (x[0], x[1])))
+        predictions_and_ratings = predictions.map(lambda x: ((x[0], x[1]), x[2])) \
+            .join(data.map(lambda x: ((x[0], x[1]), x[2]))) \
+            .values()
+    else:
+        predictions_and_ratings = broadcast_scores_and_labels(model, data)
 
     metrics = BinaryClassificationMetrics(predictions_and_ratings)
     # Area under precision-recall curve
@@ -139,19 +187,21 @@ def spark_inference(model, data):
 
 
 def main():
-    train_list_tuple, test_list_tuple, o_train, x_train = get_list_tuples()
+    distributed = len(sys.argv) > 1 and sys.argv[1] == 'distributed'
+    (rows, cols, values), test, o_train, x_train = get_triples()
     # set up environment
-    spark = SparkSession.builder \
-        .master('local[*]') \
-        .config("spark.driver.memory", "7g") \
-        .getOrCreate()
+    builder = SparkSession.builder.master('local[*]')
+    if not distributed:
+        builder = builder.config("spark.driver.memory", "7g")  # dense s_hat and r_hat on the driver
+    spark = builder.getOrCreate()
     sc = spark.sparkContext
 
-    num_partitions = 2
-    t_rdd = sc.parallelize(train_list_tuple).filter(lambda x: x[2] > 0).repartition(num_partitions)
-    test_rdd = sc.parallelize(test_list_tuple) \
-        .map(lambda x: (x[0], x[1], float(x[2])))\
-        .repartition(num_partitions)
+    num_partitions = default_num_partitions(sc)
+    sc.setCheckpointDir('als_checkpoints')  # pyspark.ml ALS lineage overflows the stack without checkpoints
+    # the executors read the Parquet parts, the triples never pass through python rows
+    triples_to_parquet('base1_triples.parquet', rows, cols, values, num_partitions)
+    s_df = read_triples_parquet(spark, 'base1_triples.parquet').cache()  # values > 1e-2 already
+    test_rdd = triples_to_dataframe(spark, test[:, 0], test[:, 1], test[:, 2], num_partitions).rdd
     ranks = [16]
     lambdas = [0.1]
     num_iters = [10]
@@ -163,10 +213,14 @@ def main():
     start_time = time()
     for rank, lmbda, numIter in itertools.product(ranks, lambdas, num_iters):
 
-        model = ALS.train(t_rdd, rank, numIter, lmbda, nonnegative=True, seed=999)
-        s_hat = spark_matrix_completion(model, (3953, 3953), rank)  # s_hat: [3953, 3953]
-        validation_auc, r_hat = manual_inference(s_hat)
-        div_score = diversity_rerank(s_hat, r_hat, o_train, x_train)
+        model = als_ml_fit(s_df, rank, numIter, lmbda, num_blocks=num_partitions, nonnegative=True, seed=999)
+        if distributed:
+            validation_auc = distributed_inference(
+                sc, model, rank, 'base1_scores/rank{}_lambda{}_iter{}'.format(rank, lmbda, numIter))
+        else:
+            s_hat = spark_matrix_completion(model, (3953, 3953), rank)  # s_hat: [3953, 3953]
+            validation_auc, r_hat = manual_inference(s_hat)
+            div_score = diversity_rerank(s_hat, r_hat, o_train, x_train)
         print("The current model was trained with rank = {} and lambda = {}, and numIter = {}, and its AUC on the "
               "validation set is {}.".format(rank, lmbda, numIter, validation_auc))
         if validation_auc > best_validation_auc:
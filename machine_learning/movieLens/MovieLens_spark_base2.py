@@ -32,6 +32,8 @@ root_path = os.path.join('/', *abs_current_path.split(os.path.sep)[:-2])
 add_path(root_path)
 
 from machine_learning.movieLens.MovieLens_sklearn_hcf_nn import split_ratings_by_time
+from machine_learning.movieLens.spark_io import collect_factors
+from machine_learning.movieLens.spark_eval import broadcast_scores_and_labels
 
 
 def parse_rating(line):
@@ -206,30 +208,27 @@ def spark_matrix_completion(model, t_shape, rank):
     :param t_shape:
     :return: completed usr, item matrices
     """
-    user_matrix = model.userFeatures().collect()
-    item_matrix = model.productFeatures().collect()
-    user_complete_matrix = np.zeros((t_shape[0], rank))
-    item_complete_matrix = np.zeros((t_shape[1], rank))
-    for row in user_matrix:
-        user_complete_matrix[row[0]] = np.array(row[1])
-
-    for row in item_matrix:
-        item_complete_matrix[row[0]] = np.array(row[1])
+    user_complete_matrix = collect_factors(model.userFeatures(), t_shape[0], rank)
+    item_complete_matrix = collect_factors(model.productFeatures(), t_shape[1], rank)
 
     t_hat = np.dot(user_complete_matrix, item_complete_matrix.T)
     return t_hat
 
 
-def spark_inference(model, data):
+def spark_inference(model, data, shuffle_join=False):
     """
     :param model:
     :param data:
+    :param shuffle_join: score with predictAll + join (two shuffles) instead of broadcast factors
     :return:
     """
-    predictions = model.predictAll(data.map(lambda x: (x[0], x[1])))
-    predictions_and_ratings = predictions.map(lambda x: ((x[0], x[1]), x[2])) \
-        .join(data.map(lambda x: ((x[0], x[1]), x[2]))) \
-        .values()
+    if shuffle_join:
+        predictions = model.predictAll(data.map(lambda x: (x[0], x[1])))
+        predictions_and_ratings = predictions.map(lambda x: ((x[0], x[1]), x[2])) \
+            .join(data.map(lambda x: ((x[0], x[1]), x[2]))) \
+            .values()
+    else:
+        predictions_and_ratings = broadcast_scores_and_labels(model, data)
 
     metrics = BinaryClassificationMetrics(predictions_and_ratings)
     # Area under precision-recall curve
@@ -4,6 +4,8 @@
 use numpy to process matrices
     1. use sklearn's MF (done)
     2. stuck at line 195: model = ALS.train(t_rdd, rank, numIter, lmbda)
+    3. python MovieLens_spark_hcf.py distributed: t_hat is scored and written by the executors, the validation AUC
+       is computed in factored form (distributed_inference), no dense matrix on the driver and no diversity
 """
 import itertools
 import os
@@ -16,7 +18,7 @@ import numpy as np
 import tqdm
 from sklearn.metrics import roc_auc_score, precision_recall_curve, plot_precision_recall_curve
 from pyspark.mllib.evaluation import BinaryClassificationMetrics
-from pyspark.mllib.recommendation import ALS, Rating, MatrixFactorizationModel
+from pyspark.mllib.recommendation import Rating, MatrixFactorizationModel
 from pyspark.sql import SparkSession
 import matplotlib.pyplot as plt
 
@@ -34,6 +36,12 @@ add_path(root_path)
 from machine_learning.movieLens.MovieLens_sklearn_hcf_nn import split_ratings_by_time
 from machine_learning.movieLens.utils import load_ratings, generate_xoy_binary, generate_xoy
 from machine_learning.movieLens.MovieLens_sklearn_hcf2vcat import diversity_excludes_train, diversity_rerank
+from machine_learning.movieLens.spark_io import dense_to_triples, default_num_partitions, triples_to_dataframe, \
+    collect_factors, model_features, triples_to_parquet, read_triples_parquet, als_ml_fit, export_factors_and_scores
+from machine_learning.movieLens.cross_validation import build_xoz
+from machine_learning.movieLens.recommend import hcf_factors
+from machine_learning.movieLens.spark_eval import broadcast_scores_and_labels
+from machine_learning.movieLens.spark_partitioning import block_relabeling, report_blocks, BlockBalancedModel
 
 
 def parse_o(line):
@@ -121,6 +129,27 @@ def get_list_tuples():
     return t_list_tuple, test_list_tuple, o_train, x_train
 
 
+def get_triples():
+    """
+    Same data as get_list_tuples, kept as numpy (rows, cols, values) arrays for spark_io
+    """
+    npz_file = 'hcf1.npz'
+    path = '../../data/movielens/medium/ratings.dat'
+    ratings = load_ratings(path)  # [i, j, rating, timestamp]
+    training, test = split_ratings_by_time(ratings, 0.8)  # (i, j, value)
+    x_train, o_train, y_train = generate_xoy(training, (6041, 3953))
+    if not os.path.isfile(npz_file):
+        t = compute_t(x_train, y_train)
+        rows, cols, values = dense_to_triples(t, 1e-6)
+        np.savez(npz_file, rows=rows, cols=cols, values=values)
+    else:
+        t_file = np.load(npz_file)
+        rows, cols, values = t_file['rows'], t_file['cols'], t_file['values']
+
+    test = normalize_validation(test)
+    return (rows, cols, values), test, o_train, x_train
+
+
 def manual_inference(t_hat):
     path = '../../data/movielens/medium/ratings.dat'
     ratings = load_ratings(path)  # [i, j, rating, timestamp]
@@ -143,16 +172,37 @@ def manual_inference(t_hat):
     return auc_score, all_scores_norm
 
 
-def spark_inference(model, data):
+def distributed_inference(sc, model, rank, out_dir, beta=0.2):
+    """
+    manual_inference without t_hat on the driver: export_factors_and_scores writes w, h and t_hat under out_dir,
+    u * t_hat = (u * w) * h.T is scored on the validation cells from [n, rank] factors (recommend.hcf_factors)
+    :return: auc
+    """
+    path = '../../data/movielens/medium/ratings.dat'
+    ratings = load_ratings(path)  # [i, j, rating, timestamp]
+    training, test = split_ratings_by_time(ratings, 0.8)
+    w, h = export_factors_and_scores(sc, model, 7906, 3953, rank, out_dir)
+    x, z, fill = build_xoz(training, (6041, 3953))  # y = z + fill, the y of generate_xoy
+    user_factors, item_factors = hcf_factors(x, z, fill, w, h.T, beta)
+    user, item = test[:, 0].astype(np.int64), test[:, 1].astype(np.int64)
+    y_scores = np.einsum('ij,ij->i', user_factors[user], item_factors[item])
+    return roc_auc_score(test[:, 2] >= 3, y_scores)  # generate_xoy_binary
+
+
+def spark_inference(model, data, shuffle_join=False):
     """
     :param model:
     :param data:
+    :param shuffle_join: score with predictAll + join (two shuffles) instead of broadcast factors
     :return:
     """
-    predictions = model.predictAll(data.map(lambda x: (x[0], x[1])))
-    predictions_and_ratings = predictions.map(lambda x: ((x[0], x[1]), x[2])) \
-        .join(data.map(lambda x: ((x[0], x[1]), x[2]))) \
-        .values()
+    if shuffle_join:
+        predictions = model.predictAll(data.map(lambda x: (x[0], x[1])))
+        predictions_and_ratings = predictions.map(lambda x: ((x[0], x[1]), x[2])) \
+            .join(data.map(lambda x: ((x[0], x[1]), x[2]))) \
+            .values()
+    else:
+        predictions_and_ratings = broadcast_scores_and_labels(model, data)
 
     metrics = BinaryClassificationMetrics(predictions_and_ratings)
     # Area under precision-recall curve
@@ -170,34 +220,36 @@ def spark_matrix_completion(model, t_shape, rank):
     :param t_shape:
     :return: completed usr, item matrices
     """
-    user_matrix = model.userFeatures().collect()
-    item_matrix = model.productFeatures().collect()
-    user_complete_matrix = np.zeros((t_shape[0], rank))
-    item_complete_matrix = np.zeros((t_shape[1], rank))
-    for row in user_matrix:
-        user_complete_matrix[row[0]] = np.array(row[1])
-
-    for row in item_matrix:
-        item_complete_matrix[row[0]] = np.array(row[1])
+    user_features, item_features = model_features(model)
+    user_complete_matrix = collect_factors(user_features, t_shape[0], rank)
+    item_complete_matrix = collect_factors(item_features, t_shape[1], rank)
 
     t_hat = np.dot(user_complete_matrix, item_complete_matrix.T)
     return t_hat
 
 
 def main():
-    t_list_tuple, test_list_tuple, o_train, x_train = get_list_tuples()
+    distributed = len(sys.argv) > 1 and sys.argv[1] == 'distributed'
+    (rows, cols, values), test, o_train, x_train = get_triples()
     # set up environment
-    spark = SparkSession.builder \
-        .master('local[*]') \
-        .config("spark.driver.memory", "7g") \
-        .getOrCreate()  # solve the ParallelRDD issue
+    builder = SparkSession.builder.master('local[*]')
+    if not distributed:
+        builder = builder.config("spark.driver.memory", "7g")  # dense t_hat and r_hat on the driver
+    spark = builder.getOrCreate()  # solve the ParallelRDD issue
     sc = spark.sparkContext
 
-    num_partitions = 2
-    t_rdd = sc.parallelize(t_list_tuple).filter(lambda x: x[2] > 0).repartition(num_partitions)
-    test_rdd = sc.parallelize(test_list_tuple) \
-        .map(lambda x: (x[0], x[1], float(x[2])))\
-        .repartition(num_partitions)
+    num_partitions = default_num_partitions(sc)
+    sc.setCheckpointDir('als_checkpoints')  # pyspark.ml ALS lineage overflows the stack without checkpoints
+    # dense T1/T2 rows of popular items are spread over the ALS blocks, factors are mapped back after training
+    row_to_new = block_relabeling(rows, num_partitions, 7906)
+    col_to_new = block_relabeling(cols, num_partitions, 3953)
+    report_blocks(rows, num_partitions, 'T rows, original ids')
+    report_blocks(row_to_new[rows], num_partitions, 'T rows, balanced ids')
+    report_blocks(col_to_new[cols], num_partitions, 'T cols, balanced ids')
+    # the executors read the Parquet parts, the triples never pass through python rows
+    triples_to_parquet('hcf1_triples.parquet', row_to_new[rows], col_to_new[cols], values, num_partitions)
+    t_df = read_triples_parquet(spark, 'hcf1_triples.parquet').cache()  # values > 1e-6 already
+    test_rdd = triples_to_dataframe(spark, test[:, 0], test[:, 1], test[:, 2], num_partitions).rdd
     ranks = [16, 12]
     lambdas = [0.1, 0.01]
     num_iters = [10, 20]
@@ -209,10 +261,15 @@ def main():
     start_time = time()
     for rank, lmbda, numIter in itertools.product(ranks, lambdas, num_iters):
 
-        model = ALS.train(t_rdd, rank, numIter, lmbda, nonnegative=True, seed=999)
-        t_hat = spark_matrix_completion(model, (7906, 3953), rank)
-        validation_auc, r_hat = manual_inference(t_hat)
-        div_score = diversity_excludes_train(t_hat, r_hat, o_train, x_train)
+        model = als_ml_fit(t_df, rank, numIter, lmbda, num_blocks=num_partitions, nonnegative=True, seed=999)
+        model = BlockBalancedModel(model, row_to_new, col_to_new)
+        if distributed:
+            validation_auc = distributed_inference(
+                sc, model, rank, 'hcf_scores/rank{}_lambda{}_iter{}'.format(rank, lmbda, numIter))
+        else:
+            t_hat = spark_matrix_completion(model, (7906, 3953), rank)
+            validation_auc, r_hat = manual_inference(t_hat)
+            div_score = diversity_excludes_train(t_hat, r_hat, o_train, x_train)
         print("The current model was trained with rank = {} and lambda = {}, and numIter = {}, and its AUC on the "
               "validation set is {}.".format(rank, lmbda, numIter, validation_auc))
         if validation_auc > best_validation_auc:
@@ -0,0 +1,114 @@
+"""
+in-process ALS on T, same objective as spark ALS.train(t_rdd, rank, num_iter, lmbda, nonnegative=True):
+only the nonzero entries of T are fitted, lambda is scaled by the number of entries per row/column.
+w, h can be passed back in to resume training.
+implicit_als_fit is the ALS.trainImplicit counterpart: every observed cell (O) is a preference of 1 with
+confidence 1 + alpha * r, unobserved cells are 0 with confidence 1. The Gram trick keeps the cost at
+O(nnz * rank^2) per sweep instead of O(n_users * n_items * rank).
+"""
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def init_factors(t_shape, rank, seed=0):
+    rs = np.random.RandomState(seed)
+    w = np.abs(rs.normal(scale=1 / np.sqrt(rank), size=(t_shape[0], rank)))
+    h = np.abs(rs.normal(scale=1 / np.sqrt(rank), size=(rank, t_shape[1])))
+    return w, h
+
+
+def _solve_rows(t, mask, fixed, lmbda, nonnegative):
+    """
+    :param fixed: [rank, n_cols] factor that is held fixed
+    :return: [n_rows, rank] least squares factor, one ridge solve per row
+    """
+    rank = fixed.shape[0]
+    out = np.zeros((t.shape[0], rank))
+    eye = np.eye(rank)
+    for i in range(t.shape[0]):
+        idx = np.flatnonzero(mask[i])
+        if idx.shape[0] == 0:
+            continue
+        f = fixed[:, idx]
+        out[i] = np.linalg.solve(f @ f.T + lmbda * idx.shape[0] * eye, f @ t[i, idx])
+    if nonnegative:
+        np.clip(out, 0, None, out=out)
+    return out
+
+
+def als_fit(t, rank, n_iter, lmbda, w=None, h=None, nonnegative=True, seed=0):
+    """
+    :param t: dense [n_rows, n_cols], entries <= 0 are unobserved
+    :param w, h: factors from an earlier call, to resume
+    :return: w [n_rows, rank], h [rank, n_cols]
+    """
+    if w is None or h is None:
+        w, h = init_factors(t.shape, rank, seed)
+    mask = t > 0
+    for _ in range(n_iter):
+        w = _solve_rows(t, mask, h, lmbda, nonnegative)
+        h = _solve_rows(t.T, mask.T, w.T, lmbda, nonnegative).T
+    return w, h
+
+
+def hcf_confidence(x, z, fill, beta=0.2):
+    """
+    :param x, z, fill: see cross_validation.build_xoz, x and z share the sparsity of O
+    :return: csr over the observed cells, x + beta * y
+    """
+    y_observed = z.copy()
+    y_observed.data += fill
+    return (x + beta * y_observed).tocsr()
+
+
+def confidence_triples(x, z, fill, beta=0.2):
+    """
+    Observed cells O as (user, item, x + beta * y) triples, the ratings of ALS.trainImplicit / implicitPrefs
+    :return: rows, cols, values
+    """
+    r = hcf_confidence(x, z, fill, beta).tocoo()
+    return r.row.astype(np.int64), r.col.astype(np.int64), r.data
+
+
+def implicit_scores(w, h, users, items):
+    """
+    :return: preference scores w[u] * h[:, i] of the (users[k], items[k]) cells
+    """
+    return np.einsum('ij,ji->i', w[users], h[:, items])
+
+
+def _implicit_solve_rows(r, fixed, lmbda, alpha):
+    """
+    :param r: csr [n_rows, n_cols], stored entries are observations
+    :param fixed: [n_cols, rank] factor that is held fixed
+    :return: [n_rows, rank]
+    """
+    rank = fixed.shape[1]
+    gram = fixed.T @ fixed  # shared by every row, covers the confidence-1 part of all cells
+    out = np.zeros((r.shape[0], rank))
+    eye = np.eye(rank)
+    for i in range(r.shape[0]):
+        lo, hi = r.indptr[i], r.indptr[i + 1]
+        if lo == hi:
+            continue
+        f = fixed[r.indices[lo:hi]]
+        c1 = alpha * r.data[lo:hi]  # c - 1 on the observed cells
+        a = gram + (f.T * c1) @ f + lmbda * (hi - lo) * eye
+        out[i] = np.linalg.solve(a, f.T @ (1 + c1))  # preference is 1 on observed cells
+    return out
+
+
+def implicit_als_fit(r, rank, n_iter, lmbda, alpha=1.0, w=None, h=None, seed=0):
+    """
+    :param r: sparse [n_users, n_items], stored entries are observations, values are confidence magnitudes
+    :param w, h: factors from an earlier call, to resume
+    :return: w [n_users, rank], h [rank, n_items], preference scores are w * h
+    """
+    r = csr_matrix(r)
+    r_t = r.T.tocsr()
+    if w is None or h is None:
+        w, h = init_factors(r.shape, rank, seed)
+    for _ in range(n_iter):
+        w = _implicit_solve_rows(r, h.T, lmbda, alpha)
+        h = _implicit_solve_rows(r_t, w, lmbda, alpha).T
+    return w, h
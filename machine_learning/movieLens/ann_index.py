@@ -0,0 +1,154 @@
+"""
+IVF approximate nearest-neighbor index over item factors, inner-product search
+    1. k-means splits the items into n_lists inverted lists, item vectors are stored contiguously per list
+    2. a query scores every centroid, then exactly scores the items of its n_probe best lists
+    3. the index is a directory of .npy files, IvfIndex.load memory-maps them
+    4. recall_latency: recall@k against exact search (recommend.retrieve_top_k) and ms per query per n_probe
+"""
+import sys
+import os
+import json
+from time import time
+
+import numpy as np
+from sklearn.decomposition import NMF
+
+
+def add_path(path):
+    if path not in sys.path:
+        print('Adding {}'.format(path))
+        sys.path.append(path)
+
+
+abs_current_path = os.path.realpath('./')
+root_path = os.path.join('/', *abs_current_path.split(os.path.sep)[:-2])
+add_path(root_path)
+
+from machine_learning.movieLens.cross_validation import prepare_holdout
+from machine_learning.movieLens.recommend import hcf_factors, retrieve_top_k, top_k
+from machine_learning.movieLens.splits import mod_split, take
+from machine_learning.movieLens.utils import load_ratings
+
+INDEX_FILES = ('centroids', 'list_offsets', 'list_ids', 'list_vectors')
+
+
+def kmeans(x, n_clusters, n_iter=20, seed=0):
+    """
+    Lloyd's k-means, empty clusters are re-seeded from random points
+    :return: centroids [n_clusters, dim] float32, assignment [n] int64
+    """
+    rs = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+    centroids = x[rs.choice(x.shape[0], n_clusters, replace=False)].copy()
+    x_sq = (x ** 2).sum(axis=1)
+    for _ in range(n_iter):
+        dist = x_sq[:, None] - 2 * x @ centroids.T + (centroids ** 2).sum(axis=1)[None, :]
+        assignment = dist.argmin(axis=1)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = x[rs.choice(x.shape[0], empty.sum(), replace=False)]
+    dist = x_sq[:, None] - 2 * x @ centroids.T + (centroids ** 2).sum(axis=1)[None, :]
+    return centroids, dist.argmin(axis=1)
+
+
+class IvfIndex(object):
+    # inverted lists of item factors; list l holds list_ids / list_vectors[list_offsets[l]:list_offsets[l + 1]]
+    def __init__(self, centroids, list_offsets, list_ids, list_vectors):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.list_vectors = list_vectors
+
+    @classmethod
+    def build(cls, item_factors, n_lists=None, n_iter=20, seed=0):
+        """
+        :param n_lists: default about sqrt(n_items)
+        """
+        item_factors = np.asarray(item_factors, dtype=np.float32)
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(item_factors.shape[0])))
+        centroids, assignment = kmeans(item_factors, n_lists, n_iter, seed)
+        order = np.argsort(assignment, kind='stable')
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=list_offsets[1:])
+        return cls(centroids, list_offsets, order.astype(np.int32), np.ascontiguousarray(item_factors[order]))
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        for name in INDEX_FILES:
+            np.save(os.path.join(index_dir, name + '.npy'), getattr(self, name))
+        with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+            json.dump({'n_lists': self.centroids.shape[0], 'n_items': self.list_ids.shape[0],
+                       'rank': self.centroids.shape[1]}, f)
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode='r'):
+        return cls(*[np.load(os.path.join(index_dir, name + '.npy'), mmap_mode=mmap_mode) for name in INDEX_FILES])
+
+    def search(self, queries, k, n_probe=8, exclude=None):
+        """
+        :param queries: [n_queries, rank] user factors or item factors ("more like this")
+        :param exclude: optional list of per-query item id arrays that must not be returned
+        :return: items [n_queries, k] int32, scores [n_queries, k] float32; -1 / -inf pad short results
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        n_probe = min(n_probe, self.centroids.shape[0])
+        probes, _ = top_k(queries @ self.centroids.T, n_probe)
+        items_out = np.full((queries.shape[0], k), -1, dtype=np.int32)
+        scores_out = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        for q in range(queries.shape[0]):
+            ranges = [(self.list_offsets[l], self.list_offsets[l + 1]) for l in probes[q]]
+            ids = np.concatenate([self.list_ids[lo:hi] for lo, hi in ranges])
+            scores = np.concatenate([self.list_vectors[lo:hi] @ queries[q] for lo, hi in ranges])
+            if ids.shape[0] == 0:
+                continue
+            if exclude is not None and len(exclude[q]):
+                scores[np.isin(ids, exclude[q])] = -np.inf
+            best, best_scores = top_k(scores[None, :], k)
+            items_out[q, :best.shape[1]] = ids[best[0]]
+            scores_out[q, :best.shape[1]] = best_scores[0]
+        return items_out, scores_out
+
+
+def recall_latency(index, item_factors, queries, k=10, n_probes=(1, 2, 4, 8, 16, 32)):
+    """
+    :return: list of (n_probe, recall@k, ms per query), plus exact search as n_probe = 'exact'
+    """
+    start_time = time()
+    exact, _ = retrieve_top_k(queries, item_factors, k)
+    exact_ms = (time() - start_time) * 1000 / queries.shape[0]
+    report = []
+    for n_probe in n_probes:
+        start_time = time()
+        approx, _ = index.search(queries, k, n_probe)
+        ms = (time() - start_time) * 1000 / queries.shape[0]
+        hits = sum(np.intersect1d(a, e).shape[0] for a, e in zip(approx, exact))
+        report.append((n_probe, hits / exact.size, ms))
+        print('n_probe {:>3}: recall@{} {:.3f}, {:.3f} ms/query'.format(n_probe, k, hits / exact.size, ms))
+    report.append(('exact', 1.0, exact_ms))
+    print('exact: {:.3f} ms/query (batched GEMM)'.format(exact_ms))
+    return report
+
+
+def main():
+    rank = 25
+    path = '../../data/movielens/medium/ratings.dat'
+    ratings = load_ratings(path)
+    train_idx, test_idx = mod_split(ratings[:, 3], 8)
+    fold = prepare_holdout(take(ratings, train_idx), take(ratings, test_idx), (6041, 3953))
+    model = NMF(n_components=rank, init='random', random_state=0, max_iter=200)
+    w = model.fit_transform(fold['t'])
+    user_factors, item_factors = hcf_factors(fold['x_train'], fold['z_train'], fold['fill'], w, model.components_)
+
+    index = IvfIndex.build(item_factors)
+    index.save('hcf_ivf')
+    index = IvfIndex.load('hcf_ivf')
+    queries = user_factors[np.random.RandomState(0).choice(user_factors.shape[0], 500, replace=False)]
+    recall_latency(index, item_factors, queries, k=10)
+
+
+if __name__ == "__main__":
+    main()
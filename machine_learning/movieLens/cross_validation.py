@@ -0,0 +1,183 @@
+"""
+k-fold cross validation of sklearn HCF, sharing precomputation across folds
+    1. X, Y are kept sparse: Y = Z + fill * ones, Z only has observed cells (parse_xoy: Z = -X, fill = 1.2)
+    2. unnormalized T1 = X.T * X, T2 = Y.T * X are computed once on all ratings
+    3. fold T = global T - contributions of the held-out cells, then masked min-max like compute_t
+    4. by_user=True folds over users (splits.user_kfold): T subtracts every rating of the held-out users, their
+       last n_test ratings are the test cells and the earlier ones stay in x_train / z_train as fold-in input
+    5. folds are fitted/scored in a thread pool, NMF and the BLAS products release the GIL
+"""
+import sys
+import os
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.metrics import roc_auc_score
+
+
+def add_path(path):
+    if path not in sys.path:
+        print('Adding {}'.format(path))
+        sys.path.append(path)
+
+
+abs_current_path = os.path.realpath('./')
+root_path = os.path.join('/', *abs_current_path.split(os.path.sep)[:-2])
+add_path(root_path)
+
+from machine_learning.movieLens.MovieLens_sklearn_hcf2vcat import mf_sklearn
+from machine_learning.movieLens.splits import kfold, user_kfold, leave_last_k
+from machine_learning.movieLens.utils import load_ratings
+
+
+def build_xoz(ratings, rating_shape, binary=False):
+    """
+    Sparse version of generate_xoy / generate_xoy_binary
+    :param ratings: matrix, row is (i, j, value, ...)
+    :return: x, z (csr), fill: dense y == z + fill on every cell
+    """
+    user = ratings[:, 0].astype(np.int64)
+    item = ratings[:, 1].astype(np.int64)
+    rating = ratings[:, 2].astype(np.float64)
+    if binary:
+        x_val = (rating >= 3).astype(np.float64)
+        z_val = 1 - x_val
+        fill = 0.
+    else:
+        x_val = rating / 5
+        fill = 6 / 5
+        z_val = (6 - rating) / 5 - fill
+    x = csr_matrix((x_val, (user, item)), shape=rating_shape)
+    z = csr_matrix((z_val, (user, item)), shape=rating_shape)
+    return x, z, fill
+
+
+def cooccurrence(x, z, fill):
+    """
+    :return: unnormalized t1 = x.T * x, t2 = y.T * x (dense, [n_items, n_items])
+    """
+    t1 = (x.T @ x).toarray()
+    t2 = (z.T @ x).toarray() + fill * np.asarray(x.sum(axis=0))
+    return t1, t2
+
+
+def cooccurrence_without(t1, t2, x, z, fill, x_d, z_d):
+    """
+    Co-occurrence after removing the held-out cells x_d, z_d from x, z, without recomputing x.T * x:
+    (a - a_d).T (b - b_d) = a.T b - a_d.T b - a.T b_d + a_d.T b_d
+    """
+    c1 = x_d.T @ x
+    t1_f = t1 - (c1 + c1.T - x_d.T @ x_d).toarray()
+    t2_f = t2 - (z_d.T @ x + z.T @ x_d - z_d.T @ x_d).toarray() - fill * np.asarray(x_d.sum(axis=0))
+    for t_f in (t1_f, t2_f):  # cancellation leaves ~1e-16 residue where the count should be 0
+        t_f[np.abs(t_f) < 1e-9 * np.abs(t_f).max()] = 0
+    return t1_f, t2_f
+
+
+def masked_min_max(t):
+    mask = t > 0
+    t_norm = (t - np.min(t[mask])) / (np.max(t[mask]) - np.min(t[mask]))  # only normalize t > 0
+    return t_norm * mask
+
+
+def prepare_folds(ratings, rating_shape, k=5, seed=0, binary=False, by_user=False, n_test=10):
+    """
+    Build everything a fold needs once, reused by every hyperparameter setting
+    :param ratings: matrix, row is (i, j, value, timestamp)
+    :param by_user: hold out users instead of rating cells, T never sees the held-out users' ratings
+    :param n_test: by_user only, most recent ratings per held-out user that are scored (splits.leave_last_k)
+    :return: list of dict(x_train, z_train, fill, t, test_user, test_item, y_true)
+    """
+    x, z, fill = build_xoz(ratings, rating_shape, binary)
+    t1, t2 = cooccurrence(x, z, fill)
+    if by_user:
+        order, bounds = user_kfold(ratings[:, 0].astype(np.int64), k, seed)
+    else:
+        order, bounds = kfold(ratings.shape[0], k, seed)
+
+    folds = []
+    for f in range(k):
+        test = ratings[order[bounds[f]:bounds[f + 1]]]
+        x_d, z_d, _ = build_xoz(test, rating_shape, binary)
+        t1_f, t2_f = cooccurrence_without(t1, t2, x, z, fill, x_d, z_d)
+        if by_user:  # the fold-in ratings go back into x_train / z_train, only the last n_test are held out
+            _, test_idx = leave_last_k(test[:, 0], test[:, 3], n_test)
+            test = test[test_idx]
+            x_d, z_d, _ = build_xoz(test, rating_shape, binary)
+        folds.append({
+            'x_train': x - x_d,
+            'z_train': z - z_d,
+            'fill': fill,
+            't': np.concatenate((masked_min_max(t1_f), masked_min_max(t2_f)), axis=0),
+            'test_user': test[:, 0].astype(np.int64),
+            'test_item': test[:, 1].astype(np.int64),
+            'y_true': (test[:, 2] >= 3).astype(np.float64),  # generate_xoy_binary
+        })
+    return folds
+
+
+def prepare_holdout(training, test, rating_shape, binary=False):
+    """
+    Single fold from an existing split (e.g. split_ratings_by_time), same layout as prepare_folds
+    """
+    x, z, fill = build_xoz(training, rating_shape, binary)
+    t1, t2 = cooccurrence(x, z, fill)
+    return {
+        'x_train': x,
+        'z_train': z,
+        'fill': fill,
+        't': np.concatenate((masked_min_max(t1), masked_min_max(t2)), axis=0),
+        'test_user': test[:, 0].astype(np.int64),
+        'test_item': test[:, 1].astype(np.int64),
+        'y_true': (test[:, 2] >= 3).astype(np.float64),
+    }
+
+
+def score_test_cells(fold, t_hat, beta, block_size=1024):
+    """
+    HCF score u * t_hat, u = concat(x_train, beta * y_train), evaluated only on the fold's test cells.
+    hcf_inference's global min-max does not change the AUC, so it is skipped.
+    """
+    n_items = t_hat.shape[1]
+    t1_hat, t2_hat = t_hat[:n_items], t_hat[n_items:]
+    fill_scores = fold['fill'] * t2_hat.sum(axis=0)
+    users, inverse = np.unique(fold['test_user'], return_inverse=True)
+    y_scores = np.empty(fold['test_user'].shape[0])
+    for start in range(0, users.shape[0], block_size):
+        block = users[start:start + block_size]
+        scores = fold['x_train'][block] @ t1_hat + beta * (fold['z_train'][block] @ t2_hat + fill_scores)
+        in_block = (inverse >= start) & (inverse < start + block_size)
+        y_scores[in_block] = scores[inverse[in_block] - start, fold['test_item'][in_block]]
+    return y_scores
+
+
+def fit_and_score(fold, rank, n_iter, beta):
+    t_hat = mf_sklearn(fold['t'], n_components=rank, n_iter=n_iter)
+    return roc_auc_score(fold['y_true'], score_test_cells(fold, t_hat, beta))
+
+
+def cross_validate(folds, rank, n_iter, beta=0.2, n_workers=None):
+    """
+    :return: list of per-fold AUC
+    """
+    with ThreadPoolExecutor(max_workers=n_workers or len(folds)) as pool:
+        return list(pool.map(lambda fold: fit_and_score(fold, rank, n_iter, beta), folds))
+
+
+def main():
+    path = '../../data/movielens/medium/ratings.dat'
+    ratings = load_ratings(path)
+    by_user = len(sys.argv) > 1 and sys.argv[1] == 'users'
+    folds = prepare_folds(ratings, (6041, 3953), k=5, by_user=by_user)
+
+    ranks = [16, 25]
+    num_iters = [50, 80]
+    for rank, num_iter in itertools.product(ranks, num_iters):
+        aucs = cross_validate(folds, rank, num_iter)
+        print("rank = {}, num_iter = {}: mean AUC {:.4f} (std {:.4f}) over {} {} folds".format(
+            rank, num_iter, np.mean(aucs), np.std(aucs), len(aucs), 'user' if by_user else 'rating'))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+training input pipeline for the Hcf network
+    1. observed cells and their (x, y) labels live in contiguous int32 / float32 tensors, built once
+    2. every epoch draws one permutation, the index tensors are permuted once and served as contiguous slices
+    3. u / v rows are gathered per batch inside the dataset, so DataLoader workers do it ahead of the network
+"""
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+
+def observed_tensors(o_list, x, y):
+    """
+    :param o_list: (i, j, value) of observed cells, list of tuples or [n, >= 2] array
+    :param x, y: dense [n_users, n_items]
+    :return: users [n] int32, items [n] int32, labels [n, 2] float32 (x, y) of each cell
+    """
+    cells = np.asarray(o_list)
+    users = np.ascontiguousarray(cells[:, 0], dtype=np.int32)
+    items = np.ascontiguousarray(cells[:, 1], dtype=np.int32)
+    labels = np.stack((x[users, items], y[users, items]), axis=1).astype(np.float32)
+    return torch.from_numpy(users), torch.from_numpy(items), torch.from_numpy(labels)
+
+
+class ObservedBatches(IterableDataset):
+    # one epoch of (u rows, v rows, labels) minibatches, workers take every num_workers-th batch;
+    # with num_replicas > 1 (data-parallel ranks) every replica first takes every num_replicas-th batch
+    def __init__(self, users, items, labels, u, v, batch_size=4096, seed=0, drop_last=True, num_replicas=1,
+                 replica=0):
+        super(ObservedBatches, self).__init__()
+        self.users = users
+        self.items = items
+        self.labels = labels
+        self.u = torch.as_tensor(np.ascontiguousarray(u, dtype=np.float32))
+        self.v = torch.as_tensor(np.ascontiguousarray(v, dtype=np.float32))
+        self.batch_size = batch_size
+        self.seed = seed
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.replica = replica
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        # call before iterating the DataLoader, every worker then draws the same permutation
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.users.shape[0] // self.batch_size
+        return -(-self.users.shape[0] // self.batch_size)
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        perm = torch.randperm(self.users.shape[0], generator=generator)
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        # equal batch count on every replica, all-reduce steps must line up
+        n_batches = len(self) // self.num_replicas * self.num_replicas
+        batches = np.arange(self.replica, n_batches, self.num_replicas)[worker_id::num_workers]
+        # this worker's cells in epoch order, batches are contiguous slices of it
+        mine = torch.cat([perm[b * self.batch_size:(b + 1) * self.batch_size] for b in batches]) \
+            if batches.shape[0] else perm[:0]
+        users = self.users[mine].long()
+        items = self.items[mine].long()
+        labels = self.labels[mine]
+        for lo in range(0, mine.shape[0], self.batch_size):
+            hi = lo + self.batch_size
+            yield self.u[users[lo:hi]], self.v[items[lo:hi]], labels[lo:hi]
+
+
+def make_loader(dataset, num_workers=0, prefetch_factor=4):
+    """
+    :return: DataLoader yielding the dataset's batches as they are, prefetched by num_workers processes
+    """
+    if num_workers == 0:
+        return DataLoader(dataset, batch_size=None)
+    return DataLoader(dataset, batch_size=None, num_workers=num_workers, prefetch_factor=prefetch_factor)
+
+
+def rating_bags(x, z):
+    """
+    :param x, z: csr from cross_validation.build_xoz, same sparsity
+    :return: indptr, indices (int64), x_val, z_val (float32) of every user's rated items
+    """
+    if x.nnz != z.nnz or not np.array_equal(x.indices, z.indices):
+        raise ValueError('x and z must share their sparsity pattern')
+    return x.indptr.astype(np.int64), x.indices.astype(np.int64), \
+        x.data.astype(np.float32), z.data.astype(np.float32)
+
+
+def gather_bags(indptr, indices, x_val, z_val, users):
+    """
+    Vectorized CSR row gather for EmbeddingBag
+    :return: bag_items, bag_offsets, x_weights, z_weights tensors for the users, in order
+    """
+    starts = indptr[users]
+    lengths = indptr[users + 1] - starts
+    offsets = np.zeros(users.shape[0], dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    flat = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+    return torch.from_numpy(indices[flat]), torch.from_numpy(offsets), \
+        torch.from_numpy(x_val[flat]), torch.from_numpy(z_val[flat])
+
+
+class ObservedBagBatches(IterableDataset):
+    # one epoch over the observed cells for HcfEmbedding: (bag_items, bag_offsets, x_weights, z_weights, items, labels)
+    def __init__(self, bags, fill, batch_size=4096, seed=0):
+        super(ObservedBagBatches, self).__init__()
+        self.indptr, self.indices, self.x_val, self.z_val = bags
+        self.users = np.repeat(np.arange(self.indptr.shape[0] - 1), np.diff(self.indptr))  # row of every cell
+        self.labels = np.stack((self.x_val, self.z_val + fill), axis=1).astype(np.float32)
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.users.shape[0] // self.batch_size
+
+    def __iter__(self):
+        perm = np.random.RandomState(self.seed + self.epoch).permutation(self.users.shape[0])
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        for b in range(worker_id, len(self), num_workers):
+            cells = perm[b * self.batch_size:(b + 1) * self.batch_size]
+            bag = gather_bags(self.indptr, self.indices, self.x_val, self.z_val, self.users[cells])
+            yield bag + (torch.from_numpy(self.indices[cells]), torch.from_numpy(self.labels[cells]))
@@ -0,0 +1,125 @@
+"""
+data-parallel CPU training of Hcf with torch.distributed (gloo) over local processes
+    1. world_size processes are spawned, each with its own torch thread count
+    2. every epoch each rank takes its shard (every world_size-th batch) of the same permutation of observed cells
+    3. DistributedDataParallel all-reduces (averages) gradients, the global batch is batch_size * world_size
+    4. scaling_benchmark trains the same epochs with 1..N processes and reports samples/s, speedup, efficiency;
+       the time is the training loop only (max over ranks), process spawn and imports are reported separately
+"""
+import sys
+import os
+import socket
+from time import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+
+def add_path(path):
+    if path not in sys.path:
+        print('Adding {}'.format(path))
+        sys.path.append(path)
+
+
+abs_current_path = os.path.realpath('./')
+root_path = os.path.join('/', *abs_current_path.split(os.path.sep)[:-2])
+add_path(root_path)
+
+from machine_learning.movieLens.hcf_nn import Hcf
+from machine_learning.movieLens.hcf_data import ObservedBatches, make_loader, observed_tensors
+from machine_learning.movieLens.MovieLens_sklearn_hcf_nn import train_hcf
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _train_rank(rank, world_size, port, threads_per_rank, data, config, state_file, train_seconds):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.set_num_threads(threads_per_rank)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    users, items, labels, u, v = data
+    torch.manual_seed(config['seed'])  # same initial weights on every rank
+    net = Hcf(in_feature=u.shape[1], hidden_feature=config['hidden_feature'])
+    model = DistributedDataParallel(net)
+    optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'])
+    dataset = ObservedBatches(users, items, labels, u, v, config['batch_size'], seed=config['seed'],
+                              num_replicas=world_size, replica=rank)
+    loader = make_loader(dataset, config['num_workers'])
+    dist.barrier()  # every rank is set up, start timing together
+    start_time = time()
+    train_hcf(model, optimizer, dataset, loader, config['n_epochs'], 'cpu', verbose=rank == 0)
+    seconds = torch.tensor([time() - start_time], dtype=torch.float64)
+    dist.all_reduce(seconds, op=dist.ReduceOp.MAX)  # the slowest rank bounds the step rate
+    if rank == 0:
+        train_seconds[0] = seconds[0]
+    if rank == 0 and state_file is not None:
+        torch.save(net.state_dict(), state_file)
+    dist.destroy_process_group()
+
+
+def train_distributed(users, items, labels, u, v, world_size, threads_per_rank=1, n_epochs=5, batch_size=4096,
+                      lr=1e-3, hidden_feature=128, num_workers=0, seed=0, state_file=None):
+    """
+    :param users, items, labels: hcf_data.observed_tensors
+    :param state_file: rank 0 saves the trained state_dict here
+    :return: training loop seconds (max over ranks), wall seconds including process spawn and imports
+    """
+    for t in (users, items, labels):
+        t.share_memory_()
+    data = (users, items, labels, np.ascontiguousarray(u, dtype=np.float32), np.ascontiguousarray(v, dtype=np.float32))
+    config = {'n_epochs': n_epochs, 'batch_size': batch_size, 'lr': lr, 'hidden_feature': hidden_feature,
+              'num_workers': num_workers, 'seed': seed}
+    train_seconds = torch.zeros(1, dtype=torch.float64).share_memory_()
+    start_time = time()
+    mp.spawn(_train_rank, args=(world_size, free_port(), threads_per_rank, data, config, state_file, train_seconds),
+             nprocs=world_size, join=True)
+    return float(train_seconds[0]), time() - start_time
+
+
+def trained_samples(n_cells, world_size, n_epochs, batch_size):
+    """
+    samples all ranks train together: ObservedBatches drops the last partial batch and every rank gets the same
+    number of batches, so the batch count is truncated to a multiple of world_size
+    """
+    return n_cells // batch_size // world_size * world_size * batch_size * n_epochs
+
+
+def scaling_benchmark(users, items, labels, u, v, world_sizes=(1, 2, 4), threads_per_rank=1, n_epochs=2,
+                      batch_size=4096):
+    """
+    :return: {world_size: (training seconds, samples per second, wall seconds)}
+    """
+    report = {}
+    for world_size in world_sizes:
+        seconds, wall_seconds = train_distributed(users, items, labels, u, v, world_size, threads_per_rank,
+                                                  n_epochs, batch_size)
+        n_samples = trained_samples(users.shape[0], world_size, n_epochs, batch_size)
+        report[world_size] = (seconds, n_samples / seconds, wall_seconds)
+    base = report[world_sizes[0]][1] / world_sizes[0]  # samples/s per process at the smallest world size
+    for world_size, (seconds, speed, wall_seconds) in report.items():
+        print('{} processes x {} threads: training {:.1f}s ({:.1f}s with start-up), {:.0f} samples/s, '
+              'speedup {:.2f}, efficiency {:.0%}'.format(world_size, threads_per_rank, seconds, wall_seconds, speed,
+                                                         speed / base, speed / (base * world_size)))
+    return report
+
+
+def main():
+    rank = 25
+    u, v, x, o_list, y = np.load('uv_25.npy', allow_pickle=True)
+    users, items, labels = observed_tensors(o_list, x, y)
+    n_cores = os.cpu_count() or 1
+    world_sizes = [n for n in (1, 2, 4, 8) if n <= n_cores]
+    scaling_benchmark(users, items, labels, u, v, world_sizes)
+    train_distributed(users, items, labels, u, v, world_sizes[-1], n_epochs=5,
+                      state_file='hcf_{}.pt'.format(rank))
+
+
+if __name__ == "__main__":
+    main()
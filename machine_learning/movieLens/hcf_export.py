@@ -0,0 +1,237 @@
+"""
+export a trained Hcf for CPU-only scoring
+    1. eval-mode BatchNorm is folded into the Linear before it (b1 / b2 are shared, so each Linear gets its own copy);
+       HcfInteraction keeps its fc_int(u1 * v1) term, other Hcf subclasses are rejected
+    2. optional int8 dynamic quantization of the Linear layers
+    3. traced to TorchScript (model.pt), or exported to ONNX (model.onnx, needs the onnx and onnxscript packages)
+    4. u / v tables saved as float32 .npy, HcfScorer memory-maps them and scores (user, item) pairs in batches;
+       export_hcf checks the exported model against the eager one on the trace example
+    5. throughput_report: pairs/s of eager, folded and quantized models, plus max abs difference to eager
+"""
+import sys
+import os
+import json
+from time import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def add_path(path):
+    if path not in sys.path:
+        print('Adding {}'.format(path))
+        sys.path.append(path)
+
+
+abs_current_path = os.path.realpath('./')
+root_path = os.path.join('/', *abs_current_path.split(os.path.sep)[:-2])
+add_path(root_path)
+
+from machine_learning.movieLens.hcf_nn import Hcf, HcfInteraction, HcfEmbedding
+
+
+class HcfFolded(nn.Module):
+    # Hcf with its BatchNorms folded away, same outputs as Hcf in eval mode
+    def __init__(self, in_feature=32, hidden_feature=128):
+        super(HcfFolded, self).__init__()
+        self.fc_u1 = nn.Linear(in_feature, hidden_feature)
+        self.fc_u2 = nn.Linear(hidden_feature, hidden_feature)
+        self.fc_v1 = nn.Linear(in_feature, hidden_feature)
+        self.fc_v2 = nn.Linear(hidden_feature, hidden_feature)
+        self.fc3 = nn.Linear(hidden_feature, 2)
+
+    def forward(self, u, v):
+        u1 = F.relu(self.fc_u1(u))
+        u1 = F.relu(self.fc_u2(u1))
+        v1 = F.relu(self.fc_v1(v))
+        v1 = F.relu(self.fc_v2(v1))
+        return self.fc3(u1 + v1)
+
+
+class HcfInteractionFolded(HcfFolded):
+    # HcfInteraction with its BatchNorms folded away
+    def __init__(self, in_feature=32, hidden_feature=128):
+        super(HcfInteractionFolded, self).__init__(in_feature, hidden_feature)
+        self.fc_int = nn.Linear(hidden_feature, 2, bias=False)
+
+    def forward(self, u, v):
+        u1 = F.relu(self.fc_u1(u))
+        u1 = F.relu(self.fc_u2(u1))
+        v1 = F.relu(self.fc_v1(v))
+        v1 = F.relu(self.fc_v2(v1))
+        return self.fc3(u1 + v1) + self.fc_int(u1 * v1)
+
+
+FOLDED = {Hcf: HcfFolded, HcfEmbedding: HcfFolded, HcfInteraction: HcfInteractionFolded}
+EXPORT_ATOL = 1e-4  # folding only reorders float32 ops
+
+
+def fold_linear_bn(linear, bn):
+    """
+    :return: Linear computing bn(linear(x)) with bn's running statistics
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    folded = nn.Linear(linear.in_features, linear.out_features)
+    with torch.no_grad():
+        folded.weight.copy_(linear.weight * scale[:, None])
+        folded.bias.copy_((linear.bias - bn.running_mean) * scale + bn.bias)
+    return folded
+
+
+def fold_batchnorm(net):
+    """
+    :param net: Hcf, HcfInteraction (or HcfEmbedding, only its head is folded)
+    :return: HcfFolded / HcfInteractionFolded in eval mode
+    """
+    if type(net) not in FOLDED:
+        raise TypeError('Cannot fold %s, its head is not one of %s' % (type(net).__name__,
+                                                                        [c.__name__ for c in FOLDED]))
+    folded = FOLDED[type(net)](net.in_feature, net.hidden_feature)
+    folded.fc_u1 = fold_linear_bn(net.fc_u1, net.b1)
+    folded.fc_u2 = fold_linear_bn(net.fc_u2, net.b1)
+    folded.fc_v1 = fold_linear_bn(net.fc_v1, net.b2)
+    folded.fc_v2 = fold_linear_bn(net.fc_v2, net.b2)
+    folded.fc3.load_state_dict(net.fc3.state_dict())
+    if isinstance(folded, HcfInteractionFolded):
+        folded.fc_int.load_state_dict(net.fc_int.state_dict())
+    return folded.eval()
+
+
+def export_error(net, model, u, v):
+    """
+    :return: max abs difference between the eager head of net (eval mode) and model on (u, v)
+    """
+    head = Hcf.forward if isinstance(net, HcfEmbedding) else type(net).forward
+    with torch.inference_mode():
+        return float((head(net, u, v) - model(u, v)).abs().max())
+
+
+def quantize(model):
+    """
+    :return: int8 dynamic quantization of the Linear layers, activations stay float32
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def export_hcf(net, u, v, out_dir, quantized=False, onnx=False, example_batch=1024):
+    """
+    Write model.pt (TorchScript, or model.onnx), u.npy, v.npy and meta.json into out_dir
+    :param u: [n_users, in_feature] user vectors, v: [n_items, in_feature] item vectors
+    :raise ValueError: unquantized export differs from the eager net by more than EXPORT_ATOL
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    net.eval()
+    model = fold_batchnorm(net)
+    if quantized:
+        model = quantize(model)
+    u = np.ascontiguousarray(u, dtype=np.float32)
+    v = np.ascontiguousarray(v, dtype=np.float32)
+    np.save(os.path.join(out_dir, 'u.npy'), u)
+    np.save(os.path.join(out_dir, 'v.npy'), v)
+
+    n = min(example_batch, u.shape[0], v.shape[0])  # the head adds the towers, both inputs need n rows
+    example = (torch.from_numpy(u[:n]), torch.from_numpy(v[:n]))
+    if onnx:
+        model_file = 'model.onnx'
+        torch.onnx.export(model, example, os.path.join(out_dir, model_file), input_names=['u', 'v'],
+                          output_names=['rating'], dynamic_axes={'u': {0: 'batch'}, 'v': {0: 'batch'},
+                                                                 'rating': {0: 'batch'}})
+    else:
+        model_file = 'model.pt'
+        with torch.inference_mode():
+            model = torch.jit.trace(model, example)
+        torch.jit.save(model, os.path.join(out_dir, model_file))
+    max_abs_diff = export_error(net, model, *example)
+    if not quantized and max_abs_diff > EXPORT_ATOL:
+        raise ValueError('Exported model differs from the eager net by %.2e' % max_abs_diff)
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'model': model_file, 'quantized': quantized, 'n_users': u.shape[0], 'n_items': v.shape[0],
+                   'in_feature': u.shape[1], 'max_abs_diff': max_abs_diff}, f)
+
+
+class HcfScorer(object):
+    # scoring runtime for export_hcf output: TorchScript model plus memory-mapped u / v tables
+    def __init__(self, model_dir, num_threads=None):
+        with open(os.path.join(model_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['model'] != 'model.pt':
+            raise ValueError('HcfScorer runs TorchScript exports, got %s' % self.meta['model'])
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.model = torch.jit.load(os.path.join(model_dir, 'model.pt'))
+        self.u = np.load(os.path.join(model_dir, 'u.npy'), mmap_mode='r')
+        self.v = np.load(os.path.join(model_dir, 'v.npy'), mmap_mode='r')
+
+    def score(self, users, items, batch_size=65536):
+        """
+        :return: [n] float32, positive-rating output for every (users[k], items[k])
+        """
+        users = np.asarray(users, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+        out = np.empty(users.shape[0], dtype=np.float32)
+        with torch.inference_mode():
+            for lo in range(0, users.shape[0], batch_size):
+                hi = min(lo + batch_size, users.shape[0])
+                u_batch = torch.from_numpy(np.take(self.u, users[lo:hi], axis=0))
+                v_batch = torch.from_numpy(np.take(self.v, items[lo:hi], axis=0))
+                out[lo:hi] = self.model(u_batch, v_batch)[:, 0].numpy()
+        return out
+
+
+def _pairs_per_second(model, u, v, pairs, batch_size, repeat=3):
+    u_t = torch.from_numpy(np.ascontiguousarray(u, dtype=np.float32))
+    v_t = torch.from_numpy(np.ascontiguousarray(v, dtype=np.float32))
+    users = torch.from_numpy(pairs[:, 0].astype(np.int64))
+    items = torch.from_numpy(pairs[:, 1].astype(np.int64))
+    out = torch.empty(pairs.shape[0])
+    best = float('inf')
+    with torch.inference_mode():
+        for _ in range(repeat):
+            start_time = time()
+            for lo in range(0, pairs.shape[0], batch_size):
+                out[lo:lo + batch_size] = model(u_t[users[lo:lo + batch_size]], v_t[items[lo:lo + batch_size]])[:, 0]
+            best = min(best, time() - start_time)
+    return pairs.shape[0] / best, out.numpy()
+
+
+def throughput_report(net, u, v, pairs, batch_size=65536):
+    """
+    :return: {variant: (pairs per second, max abs difference to eager)}
+    """
+    net.eval()
+    folded = fold_batchnorm(net)
+    example = (torch.zeros(2, u.shape[1]), torch.zeros(2, v.shape[1]))
+    with torch.inference_mode():
+        variants = {
+            'eager': net,
+            'folded': folded,
+            'folded_torchscript': torch.jit.trace(folded, example),
+            'int8_torchscript': torch.jit.trace(quantize(folded), example),
+        }
+    report = {}
+    reference = None
+    for name, model in variants.items():
+        speed, scores = _pairs_per_second(model, u, v, pairs, batch_size)
+        if reference is None:
+            reference = scores
+        report[name] = (speed, float(np.abs(scores - reference).max()))
+        print('{:>20}: {:>12.0f} pairs/s, max abs diff to eager {:.2e}'.format(name, *report[name]))
+    return report
+
+
+def main():
+    rank = 25
+    u, v, _, o_list, _ = np.load('uv_25.npy', allow_pickle=True)
+    net = Hcf(in_feature=rank * 2)
+    net.load_state_dict(torch.load('hcf_25.pt'))  # saved by MovieLens_sklearn_hcf_nn.main
+    pairs = np.asarray(o_list)[:, :2].astype(np.int64)
+    throughput_report(net, u, v, pairs)
+    export_hcf(net, u, v, 'hcf_export_int8', quantized=True)
+    scorer = HcfScorer('hcf_export_int8')
+    print(scorer.score(pairs[:10, 0], pairs[:10, 1]))
+
+
+if __name__ == "__main__":
+    main()
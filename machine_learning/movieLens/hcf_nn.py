@@ -32,3 +32,43 @@ class Hcf(nn.Module):
         out = u1 + v1
         out = self.fc3(out)
         return out
+
+
+class HcfInteraction(Hcf):
+    # Hcf's head is additive, fc3(u1 + v1), so s(u, i) - s(u, j) does not depend on u and a ranking loss only
+    # learns item popularity; fc_int(u1 * v1) adds a weighted dot product of the two towers per output
+    def __init__(self, in_feature=32, hidden_feature=128):
+        super(HcfInteraction, self).__init__(in_feature=in_feature, hidden_feature=hidden_feature)
+        self.fc_int = nn.Linear(self.hidden_feature, 2, bias=False)
+
+    def forward(self, u, v):
+        u1 = F.relu(self.b1(self.fc_u1(u)))
+        u1 = F.relu(self.b1(self.fc_u2(u1)))
+        v1 = F.relu(self.b2(self.fc_v1(v)))
+        v1 = F.relu(self.b2(self.fc_v2(v1)))
+        return self.fc3(u1 + v1) + self.fc_int(u1 * v1)
+
+
+class HcfEmbedding(Hcf):
+    # same head as Hcf, but u and v are learned from sparse rating indices instead of dense u / v tables:
+    # u+ = sum_j x_ij p_j and u- = sum_j y_ij r_j are EmbeddingBags over the user's rated items (y = z + fill,
+    # the fill part is fill * sum_j r_j), v = concat(v+, v-) is an Embedding; all start from the NMF factors
+    def __init__(self, p, r, v, fill=0., hidden_feature=128):
+        super(HcfEmbedding, self).__init__(in_feature=p.shape[1] + r.shape[1], hidden_feature=hidden_feature)
+        self.fill = fill
+        self.pos_bag = nn.EmbeddingBag.from_pretrained(torch.as_tensor(p, dtype=torch.float32), freeze=False,
+                                                       mode='sum')
+        self.neg_bag = nn.EmbeddingBag.from_pretrained(torch.as_tensor(r, dtype=torch.float32), freeze=False,
+                                                       mode='sum')
+        self.item_embedding = nn.Embedding.from_pretrained(torch.as_tensor(v, dtype=torch.float32), freeze=False)
+
+    def user_vectors(self, bag_items, bag_offsets, x_weights, z_weights):
+        pos_u = self.pos_bag(bag_items, bag_offsets, per_sample_weights=x_weights)
+        neg_u = self.neg_bag(bag_items, bag_offsets, per_sample_weights=z_weights)
+        if self.fill != 0:
+            neg_u = neg_u + self.fill * self.neg_bag.weight.sum(dim=0)
+        return torch.cat((pos_u, neg_u), dim=1)
+
+    def forward(self, bag_items, bag_offsets, x_weights, z_weights, items):
+        u = self.user_vectors(bag_items, bag_offsets, x_weights, z_weights)
+        return super(HcfEmbedding, self).forward(u, self.item_embedding(items))
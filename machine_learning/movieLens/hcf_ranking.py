@@ -0,0 +1,215 @@
+"""
+pairwise (BPR) training mode for Hcf, the evaluation is ranking AUC so train a ranking loss
+    1. positives are observed cells with a high x label, negatives are unobserved cells
+    2. negative items are drawn in one vectorized call from an alias table over item popularity ** power,
+       draws that hit an observed cell of the user are redrawn; users whose observed items hold more than
+       max_observed_mass of the sampling mass are dropped, they could not be given negatives in a few rounds
+    3. loss is -log sigmoid(score(u, i) - score(u, j)) over batched (u, i, j) triplets, score is the first output of
+       HcfInteraction (Hcf's additive head makes the difference independent of the user)
+    4. per epoch: loss, triplets/s, sampled examples so far and validation AUC; stops at target_auc
+"""
+import sys
+import os
+from time import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import IterableDataset, get_worker_info
+from sklearn.metrics import roc_auc_score
+
+
+def add_path(path):
+    if path not in sys.path:
+        print('Adding {}'.format(path))
+        sys.path.append(path)
+
+
+abs_current_path = os.path.realpath('./')
+root_path = os.path.join('/', *abs_current_path.split(os.path.sep)[:-2])
+add_path(root_path)
+
+from machine_learning.movieLens.hcf_nn import HcfInteraction
+from machine_learning.movieLens.hcf_data import make_loader
+from machine_learning.movieLens.utils import generate_xoy_binary, load_ratings
+from machine_learning.movieLens.MovieLens_sklearn_hcf_nn import hcf_nn_scores, split_ratings
+
+
+def alias_table(weights):
+    """
+    Walker's alias method, O(1) per draw
+    :return: prob [n] float64, alias [n] int64
+    """
+    n = weights.shape[0]
+    scaled = np.asarray(weights, dtype=np.float64) * n / np.sum(weights)
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = list(np.flatnonzero(scaled < 1))
+    large = list(np.flatnonzero(scaled >= 1))
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1 - scaled[s]
+        (small if scaled[l] < 1 else large).append(l)
+    return prob, alias
+
+
+def alias_draw(prob, alias, size, rs):
+    idx = rs.randint(0, prob.shape[0], size)
+    return np.where(rs.random_sample(size) < prob[idx], idx, alias[idx])
+
+
+def popularity_weights(items, n_items, power=0.75):
+    """
+    :return: [n_items] sampling weights, count ** power, unseen items get the weight of a single rating
+    """
+    counts = np.bincount(items, minlength=n_items).astype(np.float64)
+    return np.maximum(counts, 1) ** power
+
+
+def observed_mass(users, items, weights):
+    """
+    :return: [n_users] share of the sampling weights that falls on each user's observed items
+    """
+    cells = np.unique(np.stack((users, items), axis=1), axis=0)
+    mass = np.bincount(cells[:, 0], weights=weights[cells[:, 1]] / np.sum(weights))
+    return mass
+
+
+def sample_negatives(users, prob, alias, observed_keys, n_items, rs, max_rounds=50):
+    """
+    :param observed_keys: sorted user * n_items + item of every observed cell
+    :return: [len(users)] items j with (users[k], j) unobserved
+    :raise ValueError: some draws still hit observed cells after max_rounds
+    """
+    negatives = alias_draw(prob, alias, users.shape[0], rs)
+    redraw = np.arange(users.shape[0])
+    for _ in range(max_rounds):
+        keys = users[redraw] * n_items + negatives[redraw]
+        pos = np.minimum(np.searchsorted(observed_keys, keys), observed_keys.shape[0] - 1)
+        redraw = redraw[observed_keys[pos] == keys]
+        if redraw.shape[0] == 0:
+            break
+        negatives[redraw] = alias_draw(prob, alias, redraw.shape[0], rs)
+    else:
+        keys = users[redraw] * n_items + negatives[redraw]
+        pos = np.minimum(np.searchsorted(observed_keys, keys), observed_keys.shape[0] - 1)
+        if (observed_keys[pos] == keys).any():
+            raise ValueError('no unobserved negative after {} rounds for users {}'.format(
+                max_rounds, np.unique(users[redraw][observed_keys[pos] == keys])))
+    return negatives
+
+
+class BprTriplets(IterableDataset):
+    # one epoch over the positive cells, each with n_negatives sampled unobserved items: (u, v_pos, v_neg)
+    def __init__(self, users, items, labels, u, v, positive_min=0.5, batch_size=4096, n_negatives=1,
+                 power=0.75, seed=0, max_observed_mass=0.5):
+        super(BprTriplets, self).__init__()
+        users = np.asarray(users, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+        n_items = v.shape[0]
+        weights = popularity_weights(items, n_items, power)
+        mass = observed_mass(users, items, weights)
+        positive = (np.asarray(labels)[:, 0] >= positive_min) & (mass[users] <= max_observed_mass)
+        dropped = np.unique(users[mass[users] > max_observed_mass])
+        if dropped.shape[0]:
+            print('BprTriplets: dropped {} users with observed sampling mass > {}'.format(
+                dropped.shape[0], max_observed_mass))
+        self.pos_users = users[positive]
+        self.pos_items = items[positive]
+        self.observed_keys = np.unique(users * n_items + items)
+        self.prob, self.alias = alias_table(weights)
+        self.u = torch.as_tensor(np.ascontiguousarray(u, dtype=np.float32))
+        self.v = torch.as_tensor(np.ascontiguousarray(v, dtype=np.float32))
+        self.n_items = n_items
+        self.batch_size = batch_size
+        self.n_negatives = n_negatives
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return -(-self.pos_users.shape[0] // self.batch_size)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        perm = np.random.RandomState(self.seed + self.epoch).permutation(self.pos_users.shape[0])
+        rs = np.random.RandomState((self.seed + self.epoch) * 1009 + worker_id)
+        for b in range(worker_id, len(self), num_workers):
+            cells = np.repeat(perm[b * self.batch_size:(b + 1) * self.batch_size], self.n_negatives)
+            users = self.pos_users[cells]
+            negatives = sample_negatives(users, self.prob, self.alias, self.observed_keys, self.n_items, rs)
+            yield self.u[users], self.v[self.pos_items[cells]], self.v[negatives]
+
+
+def bpr_loss(net, u, v_pos, v_neg):
+    """
+    :return: mean -log sigmoid(s(u, i) - s(u, j)); positives and negatives go through one forward pass
+    """
+    scores = net(torch.cat((u, u)), torch.cat((v_pos, v_neg)))[:, 0]
+    return -F.logsigmoid(scores[:u.shape[0]] - scores[u.shape[0]:]).mean()
+
+
+def train_bpr(net, optimizer, dataset, loader, n_epochs, device, eval_fn=None, target_auc=None):
+    """
+    :param eval_fn: net -> validation AUC, called after every epoch
+    :return: list of per-epoch dicts (epoch, loss, seconds, triplets_per_s, examples, auc)
+    """
+    history = []
+    examples = 0
+    for epoch in range(n_epochs):
+        net.train()
+        dataset.set_epoch(epoch)
+        start_time = time()
+        n_triplets = 0
+        total_loss = 0.
+        for u, v_pos, v_neg in loader:
+            u, v_pos, v_neg = u.to(device), v_pos.to(device), v_neg.to(device)
+            optimizer.zero_grad()
+            loss = bpr_loss(net, u, v_pos, v_neg)
+            loss.backward()
+            optimizer.step()
+            n_triplets += u.shape[0]
+            total_loss += loss.item() * u.shape[0]
+        seconds = time() - start_time
+        examples += n_triplets
+        auc = eval_fn(net) if eval_fn is not None else None
+        history.append({'epoch': epoch, 'loss': total_loss / max(n_triplets, 1), 'seconds': seconds,
+                        'triplets_per_s': n_triplets / seconds, 'examples': examples, 'auc': auc})
+        print('epoch {}: bpr loss {:.5f}, {:.0f} triplets/s, {} examples, auc {}'.format(
+            epoch, history[-1]['loss'], history[-1]['triplets_per_s'], examples, auc))
+        if target_auc is not None and auc is not None and auc >= target_auc:
+            print('target auc {} reached after {} sampled examples'.format(target_auc, examples))
+            break
+    return history
+
+
+def main():
+    rank = 25
+    u, v, x, o_list, y = np.load('uv_25.npy', allow_pickle=True)
+    cells = np.asarray(o_list)[:, :2].astype(np.int64)
+    labels = np.stack((x[cells[:, 0], cells[:, 1]], y[cells[:, 0], cells[:, 1]]), axis=1)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    path = '../../data/movielens/medium/ratings.dat'
+    training, test = split_ratings(load_ratings(path), 8)
+    x_test, o_test, _ = generate_xoy_binary(test, (6041, 3953))
+    test_pairs = np.argwhere(o_test > 0)
+    y_true = x_test[o_test > 0]
+
+    def eval_fn(net):
+        return roc_auc_score(y_true, hcf_nn_scores(net, u, v, test_pairs, device))
+
+    # x = rating / 5 on observed cells, ratings >= 3 are positives
+    dataset = BprTriplets(cells[:, 0], cells[:, 1], labels, u, v, positive_min=0.6, batch_size=4096)
+    net = HcfInteraction(in_feature=rank * 2).to(device)
+    optimizer = torch.optim.Adam(net.parameters(), lr=1e-3)
+    train_bpr(net, optimizer, dataset, make_loader(dataset, num_workers=2), 10, device, eval_fn, target_auc=0.75)
+
+
+if __name__ == "__main__":
+    main()
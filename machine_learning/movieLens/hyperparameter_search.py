@@ -0,0 +1,155 @@
+"""
+successive halving over (rank, lambda, beta), num_iter is the budget
+    1. every config trains a few iterations, is scored on the cached test cells of the holdout
+    2. the top 1 / eta configs resume from their checkpointed factors with eta times the iterations; checkpoints are
+       keyed by backend, seed, a fingerprint of the fold's T and (rank, lambda), a checkpoint that is further along
+       than the rung (an earlier, longer search) is not resumed
+    3. backends: 'nmf' (sklearn NMF, warm started with init='custom') and 'als' (als.als_fit)
+    4. every evaluation is appended to a json lines log
+"""
+import sys
+import os
+import json
+import hashlib
+import itertools
+import warnings
+from time import time
+import numpy as np
+from sklearn.decomposition import NMF
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.metrics import roc_auc_score
+
+
+def add_path(path):
+    if path not in sys.path:
+        print('Adding {}'.format(path))
+        sys.path.append(path)
+
+
+abs_current_path = os.path.realpath('./')
+root_path = os.path.join('/', *abs_current_path.split(os.path.sep)[:-2])
+add_path(root_path)
+
+from machine_learning.movieLens.als import als_fit
+from machine_learning.movieLens.cross_validation import prepare_holdout, score_test_cells
+from machine_learning.movieLens.MovieLens_sklearn_hcf_nn import split_ratings_by_time
+from machine_learning.movieLens.utils import load_ratings
+
+
+def nmf_fit(t, rank, n_iter, lmbda, w=None, h=None, seed=0):
+    if w is None or h is None:
+        model = NMF(n_components=rank, init='random', random_state=seed, max_iter=n_iter,
+                    alpha_W=lmbda, alpha_H='same')
+        w = model.fit_transform(t)
+    else:
+        model = NMF(n_components=rank, init='custom', max_iter=n_iter, alpha_W=lmbda, alpha_H='same')
+        w = model.fit_transform(t, W=w, H=h)
+    return w, model.components_
+
+
+BACKENDS = {'nmf': nmf_fit, 'als': als_fit}
+
+
+def config_id(config):
+    return 'rank{}_lambda{}_beta{}'.format(config['rank'], config['lambda'], config['beta'])
+
+
+def fold_fingerprint(fold):
+    """
+    :return: short hash of the fold's training matrix T, a different split / fold / data set gets other checkpoints
+    """
+    t = np.ascontiguousarray(fold['t'])
+    return hashlib.sha1(str(t.shape).encode() + t.tobytes()).hexdigest()[:12]
+
+
+def factor_id(config, backend, seed, fingerprint):
+    # beta only weights Y at scoring time, configs that differ in beta share one factorization
+    return '{}_seed{}_{}_rank{}_lambda{}'.format(backend, seed, fingerprint, config['rank'], config['lambda'])
+
+
+def load_checkpoint(checkpoint_dir, name):
+    path = os.path.join(checkpoint_dir, name + '.npz')
+    if not os.path.isfile(path):
+        return None, None, 0
+    state = np.load(path)
+    return state['w'], state['h'], int(state['n_iter'])
+
+
+def save_checkpoint(checkpoint_dir, name, w, h, n_iter):
+    np.savez(os.path.join(checkpoint_dir, name + '.npz'), w=w, h=h, n_iter=n_iter)
+
+
+def train_and_score(fold, config, n_iter, backend, checkpoint_dir, seed=0, fingerprint=None):
+    """
+    Train config up to n_iter total iterations, resuming from its checkpoint
+    :param fingerprint: fold_fingerprint(fold), computed once per search
+    :return: AUC on the fold's test cells
+    """
+    fit = BACKENDS[backend]
+    name = factor_id(config, backend, seed, fold_fingerprint(fold) if fingerprint is None else fingerprint)
+    w, h, done_iter = load_checkpoint(checkpoint_dir, name)
+    if done_iter > n_iter:  # left by a longer search, resuming it would give this rung more than n_iter
+        w, h, done_iter = None, None, 0
+    if n_iter > done_iter:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', ConvergenceWarning)  # short rungs stop at max_iter on purpose
+            w, h = fit(fold['t'], config['rank'], n_iter - done_iter, config['lambda'], w=w, h=h, seed=seed)
+        save_checkpoint(checkpoint_dir, name, w, h, n_iter)
+    return roc_auc_score(fold['y_true'], score_test_cells(fold, np.dot(w, h), config['beta']))
+
+
+def successive_halving(fold, configs, min_iter, max_iter, eta=3, backend='nmf',
+                       checkpoint_dir='sh_checkpoints', log_file='sh_log.jsonl', seed=0):
+    """
+    :param fold: cached train/test cells, see cross_validation.prepare_holdout
+    :param configs: list of dict(rank, lambda, beta)
+    :param min_iter: iterations of the first rung
+    :param max_iter: iterations of the last rung
+    :param eta: keep the top 1 / eta configs per rung, multiply their iterations by eta
+    :param seed: initialization seed of every factorization, part of the checkpoint key
+    :return: best config, its AUC
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    fingerprint = fold_fingerprint(fold)
+    survivors = list(configs)
+    n_iter = min_iter
+    rung = 0
+    with open(log_file, 'a') as log:
+        while True:
+            results = []
+            for config in survivors:
+                start_time = time()
+                auc = train_and_score(fold, config, n_iter, backend, checkpoint_dir, seed, fingerprint)
+                results.append((auc, config))
+                log.write(json.dumps({'rung': rung, 'backend': backend, 'seed': seed, 'fold': fingerprint,
+                                      'n_iter': n_iter, 'auc': auc,
+                                      'seconds': time() - start_time, **config}) + '\n')
+                log.flush()
+                print("rung {}: {} num_iter = {}, AUC = {}".format(rung, config_id(config), n_iter, auc))
+            results.sort(key=lambda r: r[0], reverse=True)
+            if n_iter >= max_iter:
+                return results[0][1], results[0][0]
+            survivors = [config for _, config in results[:max(1, len(results) // eta)]]
+            n_iter = min(n_iter * eta, max_iter)
+            rung += 1
+
+
+def main():
+    path = '../../data/movielens/medium/ratings.dat'
+    ratings = load_ratings(path)
+    training, test = split_ratings_by_time(ratings, 0.8)
+    fold = prepare_holdout(training, test, (6041, 3953))
+
+    ranks = [8, 12, 16, 25]
+    lambdas = [0., 0.01, 0.1]
+    betas = [0.2, 0.5]
+    configs = [{'rank': rank, 'lambda': lmbda, 'beta': beta}
+               for rank, lmbda, beta in itertools.product(ranks, lambdas, betas)]
+    for backend in ['nmf', 'als']:
+        best_config, best_auc = successive_halving(fold, configs, min_iter=5, max_iter=80, backend=backend,
+                                                   checkpoint_dir='sh_checkpoints_' + backend)
+        print("The best {} model was {} with AUC {}".format(backend, config_id(best_config), best_auc))
+
+
+if __name__ == "__main__":
+    main()
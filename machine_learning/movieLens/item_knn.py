@@ -0,0 +1,138 @@
+"""
+item-kNN baseline: no factorization, S = X.T * X is kept sparse with only the top-k neighbors of every item
+    1. fit: ItemSimilarity over the binary training matrix, 'cooccurrence' (S) or 'cosine' (S / (|x_i| |x_j|))
+    2. scores = X[users] * W, sparse x sparse, only the neighbors of items a user rated are touched
+    3. recommend (batch) / recommend_user (single user): top-k unseen items, -1 / -inf pad short lists
+    4. knn_inference: AUROC on the observed test cells, same protocol as baseline_inference; the sparse scores
+       also go into diversity_excludes_train
+"""
+import sys
+import os
+import itertools
+from time import time
+
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+from sklearn.metrics import roc_auc_score
+
+
+def add_path(path):
+    if path not in sys.path:
+        print('Adding {}'.format(path))
+        sys.path.append(path)
+
+
+abs_current_path = os.path.realpath('./')
+root_path = os.path.join('/', *abs_current_path.split(os.path.sep)[:-2])
+add_path(root_path)
+
+from machine_learning.movieLens.item_similarity import ItemSimilarity
+from machine_learning.movieLens.utils import generate_xoy_binary, load_ratings
+from machine_learning.movieLens.MovieLens_sklearn_hcf_nn import split_ratings_by_time
+from machine_learning.movieLens.MovieLens_sklearn_hcf2vcat import diversity_excludes_train
+
+
+class ItemKnn(object):
+    # w: csr [n_items, n_items], row i holds the top-k neighbors of item i
+    def __init__(self, n_neighbors=50, similarity='cooccurrence', n_jobs=4):
+        self.n_neighbors = n_neighbors
+        self.similarity = similarity
+        self.n_jobs = n_jobs
+        self.x = None
+        self.seen = None
+        self.w = None
+
+    def fit(self, x_train, o_train=None):
+        """
+        :param x_train: [n_users, n_items] binary training matrix, dense or sparse
+        :param o_train: observed training cells, never recommended; default x_train
+        """
+        self.x = csr_matrix(x_train, dtype=np.float32)
+        self.seen = csr_matrix(self.x if o_train is None else o_train, dtype=np.int8)
+        a = self.x
+        if self.similarity == 'cosine':
+            norms = np.sqrt(np.asarray(self.x.multiply(self.x).sum(axis=0))).ravel()
+            a = self.x @ diags(np.where(norms > 0, 1 / np.maximum(norms, 1e-12), 0).astype(np.float32))
+        index = ItemSimilarity.from_factors(a, self.n_neighbors, n_jobs=self.n_jobs, normalize=False)
+        self.w = index.to_csr()
+        return self
+
+    def scores(self, users=None):
+        """
+        :return: csr [len(users), n_items], nonzero only for neighbors of the users' rated items
+        """
+        x = self.x if users is None else self.x[np.asarray(users)]
+        return x @ self.w
+
+    def recommend(self, users=None, k=10):
+        """
+        :return: items [len(users), k] int32, scores [len(users), k] float32
+        """
+        users = np.arange(self.x.shape[0]) if users is None else np.asarray(users)
+        scores = self.scores(users)
+        items_out = np.full((users.shape[0], k), -1, dtype=np.int32)
+        scores_out = np.full((users.shape[0], k), -np.inf, dtype=np.float32)
+        for row, user in enumerate(users):
+            lo, hi = scores.indptr[row], scores.indptr[row + 1]
+            items, values = scores.indices[lo:hi], scores.data[lo:hi]
+            unseen = ~np.isin(items, self.seen.indices[self.seen.indptr[user]:self.seen.indptr[user + 1]])
+            items, values = items[unseen], values[unseen]
+            if items.shape[0] > k:
+                best = np.argpartition(-values, k - 1)[:k]
+                items, values = items[best], values[best]
+            order = np.argsort(-values, kind='stable')
+            items_out[row, :order.shape[0]] = items[order]
+            scores_out[row, :order.shape[0]] = values[order]
+        return items_out, scores_out
+
+    def recommend_user(self, user, k=10):
+        items, scores = self.recommend([user], k)
+        keep = items[0] >= 0
+        return items[0][keep], scores[0][keep]
+
+    def nbytes(self):
+        return self.w.data.nbytes + self.w.indices.nbytes + self.w.indptr.nbytes
+
+
+def knn_inference(model, test, rating_shape):
+    """
+    :return: auc on the observed test cells, sparse scores of every user
+    """
+    x_test, o_test, y_test = generate_xoy_binary(test, rating_shape)
+    scores = model.scores()
+    rows, cols = np.nonzero(o_test > 0)
+    y_scores = np.asarray(scores[rows, cols]).ravel()
+    auc_score = roc_auc_score(x_test[rows, cols], y_scores)
+    return auc_score, scores
+
+
+def main():
+    path = '../../data/movielens/medium/ratings.dat'
+    ratings = load_ratings(path)
+    training, test = split_ratings_by_time(ratings, 0.8)
+    x_train, o_train, y_train = generate_xoy_binary(training, (6041, 3953))
+
+    neighbors = [20, 50, 100, 200]
+    similarities = ['cooccurrence', 'cosine']
+    best_model = None
+    best_validation_auc = float("-inf")
+
+    for n_neighbors, similarity in itertools.product(neighbors, similarities):
+        start_time = time()
+        model = ItemKnn(n_neighbors, similarity).fit(x_train, o_train)
+        fit_seconds = time() - start_time
+        valid_auc, _ = knn_inference(model, test, (6041, 3953))
+        print("item-kNN with n_neighbors = {}, similarity = {}: AUC {:.4f}, fit {:.2f}s, {:.1f} MB".format(
+            n_neighbors, similarity, valid_auc, fit_seconds, model.nbytes() / 2 ** 20))
+        if valid_auc > best_validation_auc:
+            best_model = model
+            best_validation_auc = valid_auc
+
+    _, scores = knn_inference(best_model, test, (6041, 3953))
+    diversity_score = diversity_excludes_train(ItemSimilarity.from_factors(best_model.x), scores, o_train, x_train)
+    print("The best item-kNN has n_neighbors = {}, similarity = {}: AUC {:.4f}, diversity {:.4f}".format(
+        best_model.n_neighbors, best_model.similarity, best_validation_auc, diversity_score))
+
+
+if __name__ == "__main__":
+    main()
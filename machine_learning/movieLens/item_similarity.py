@@ -0,0 +1,139 @@
+"""
+sparse top-N item-similarity index, replaces the dense item x item sim_matrix / div_matrix of the diversity metrics
+    1. only the n_neighbors most similar items of every item are kept, CSR [n_items, n_items] with sorted columns
+    2. built blockwise from a similarity matrix (dense or sparse) or from factors as A.T * A, blocks in parallel threads
+    3. normalize: the masked min-max of diversity_excludes_train, sim = (sim - min(sim > 0)) / (max - min(sim > 0)),
+       min / max over every row of the input (also the rows past n_items of a tall t_hat), non-positive pairs are
+       dropped
+    4. pair lookups are vectorized searches in the sorted row * n_items + column keys, pairs that are not stored get
+       default_div (1 - 0, what the dense div_matrix has for non-positive pairs); symmetric=True (A.T * A) looks up
+       both directions, otherwise div[a, b] is directional like the dense matrix
+    5. DenseSimilarity: the old dense div_matrix behind the same dissimilarity(a, b), exact for any dense input
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+from machine_learning.movieLens.recommend import top_k
+
+
+def block_top_n(block, row_offset, n_neighbors, n_items):
+    """
+    :param block: [b, n_items] similarities of rows row_offset .. row_offset + b
+    :return: columns, values of the n_neighbors largest off-diagonal entries of the rows < n_items, min positive and
+             max over the whole block
+    """
+    block = np.array(block, dtype=np.float32)
+    positive = block[block > 0]
+    lo = positive.min() if positive.shape[0] else np.inf
+    hi = block.max() if block.size else -np.inf
+    block = block[:max(0, n_items - row_offset)]
+    rows = np.arange(block.shape[0])
+    block[rows, rows + row_offset] = -np.inf  # an item is not its own neighbor
+    columns, values = top_k(block, n_neighbors)
+    return columns, values, lo, hi
+
+
+class ItemSimilarity(object):
+    # top-N neighbors per item in CSR form, keys[p] = row * n_items + indices[p] for pair lookups
+    def __init__(self, indptr, indices, data, n_items, default_div=1.0, symmetric=True):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.n_items = n_items
+        self.default_div = default_div
+        self.symmetric = symmetric
+        rows = np.repeat(np.arange(indptr.shape[0] - 1, dtype=np.int64), np.diff(indptr))
+        self.keys = rows * n_items + indices
+
+    @classmethod
+    def build(cls, block_fn, n_items, n_neighbors=100, block_size=512, n_jobs=4, normalize=True, default_div=1.0,
+              symmetric=True, n_rows=None):
+        """
+        :param block_fn: block_fn(lo, hi) -> similarities [hi - lo, n_items] of rows lo .. hi
+        :param n_rows: rows of the similarity matrix, default n_items; rows past n_items only enter the min-max
+        """
+        n_neighbors = min(n_neighbors, n_items - 1)
+        n_rows = n_items if n_rows is None else n_rows
+
+        def run(lo):
+            hi = min(lo + block_size, n_rows)
+            return block_top_n(block_fn(lo, hi), lo, n_neighbors, n_items)
+
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            blocks = list(pool.map(run, range(0, n_rows, block_size)))
+        columns = np.concatenate([b[0] for b in blocks]).astype(np.int64)
+        values = np.concatenate([b[1] for b in blocks])
+        lo, hi = min(b[2] for b in blocks), max(b[3] for b in blocks)
+        keep = values > 0
+        if normalize and hi > lo:
+            values = (values - lo) / (hi - lo)
+            keep &= values > 0
+        order = np.argsort(columns + np.arange(n_items)[:, None] * n_items, axis=None)
+        columns, values, keep = columns.ravel()[order], values.ravel()[order], keep.ravel()[order]
+        indptr = np.zeros(n_items + 1, dtype=np.int64)
+        np.cumsum(keep.reshape(n_items, -1).sum(axis=1), out=indptr[1:])
+        return cls(indptr, columns[keep], values[keep].astype(np.float32), n_items, default_div, symmetric)
+
+    @classmethod
+    def from_matrix(cls, sim_matrix, n_neighbors=100, **kwargs):
+        """
+        :param sim_matrix: dense or sparse [>= n_items, n_items], e.g. t1_hat or t_hat; rows past n_items are only
+                           used for the min-max, lookups are directional unless symmetric=True is passed
+        """
+        n_items = sim_matrix.shape[1]
+
+        def block_fn(lo, hi):
+            block = sim_matrix[lo:hi]
+            return block.toarray() if issparse(block) else block
+
+        kwargs.setdefault('symmetric', False)
+        return cls.build(block_fn, n_items, n_neighbors, n_rows=sim_matrix.shape[0], **kwargs)
+
+    @classmethod
+    def from_factors(cls, a, n_neighbors=100, **kwargs):
+        """
+        sim = a.T * a without materializing it, a: [n, n_items] dense or sparse (e.g. t1_hat_norm, x_train)
+        """
+        at = a.T.tocsr() if issparse(a) else np.asarray(a).T
+
+        def block_fn(lo, hi):
+            block = at[lo:hi] @ a
+            return block.toarray() if issparse(block) else block
+
+        return cls.build(block_fn, a.shape[1], n_neighbors, **kwargs)
+
+    def to_csr(self):
+        return csr_matrix((self.data, self.indices, self.indptr), shape=(self.n_items, self.n_items))
+
+    def _find(self, a, b):
+        keys = np.asarray(a, dtype=np.int64) * self.n_items + np.asarray(b, dtype=np.int64)
+        if self.keys.shape[0] == 0:
+            return np.full(keys.shape, np.nan, dtype=np.float32)
+        pos = np.minimum(np.searchsorted(self.keys, keys), self.keys.shape[0] - 1)
+        return np.where(self.keys[pos] == keys, self.data[pos], np.nan)
+
+    def similarity(self, a, b):
+        """
+        :return: similarity of the pairs (a[i], b[i]), nan where not stored; symmetric: the larger of both directions
+        """
+        if not self.symmetric:
+            return self._find(a, b)
+        return np.fmax(self._find(a, b), self._find(b, a))
+
+    def dissimilarity(self, a, b):
+        sim = self.similarity(a, b)
+        return np.where(np.isnan(sim), self.default_div, 1 - sim)
+
+
+class DenseSimilarity(object):
+    # the dense div_matrix the diversity functions used to build, same dissimilarity(a, b) as ItemSimilarity
+    def __init__(self, sim_matrix):
+        mask = sim_matrix > 0
+        sim_matrix = (sim_matrix - np.min(sim_matrix[mask])) / (np.max(sim_matrix[mask]) - np.min(sim_matrix[mask]))
+        sim_matrix *= mask
+        self.div_matrix = 1 - sim_matrix
+
+    def dissimilarity(self, a, b):
+        return self.div_matrix[a, b]
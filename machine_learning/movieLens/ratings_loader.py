@@ -0,0 +1,160 @@
+"""
+load MovieLens ratings into a binary columnar cache
+    1. single ratings.dat file, or a Hadoop-style directory of part-0000N files
+    2. parts are parsed in parallel worker processes
+    3. columns are cached as .npy files and memory-mapped on later loads; check_crc still verifies the parts when
+       the cache is fresh
+"""
+import os
+import struct
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+
+COLUMNS = ('user', 'item', 'rating', 'timestamp')
+COLUMN_DTYPES = {'user': np.int32, 'item': np.int32, 'rating': np.float32, 'timestamp': np.int64}
+
+
+def is_partitioned(ratings_path):
+    """
+    A partitioned ratings path is a directory written by Spark/Hadoop (part-0000N files)
+    """
+    return os.path.isdir(ratings_path)
+
+
+def list_parts(ratings_dir):
+    """
+    :return: sorted paths of the part-* files, hidden (., _) files are skipped like Hadoop does
+    """
+    parts = [name for name in os.listdir(ratings_dir)
+             if name.startswith('part-') and os.path.isfile(os.path.join(ratings_dir, name))]
+    return [os.path.join(ratings_dir, name) for name in sorted(parts)]
+
+
+def verify_crc(part_file):
+    """
+    Check a part file against its Hadoop .crc sidecar: b'crc\\0', int32 bytes_per_sum, then
+    one big-endian CRC32 per chunk.
+    :return: True if the sidecar matches, or there is no sidecar
+    """
+    crc_file = os.path.join(os.path.dirname(part_file), '.' + os.path.basename(part_file) + '.crc')
+    if not os.path.isfile(crc_file):
+        return True
+    with open(crc_file, 'rb') as fh:
+        header = fh.read(8)
+        if header[:4] != b'crc\x00':
+            return False
+        bytes_per_sum = struct.unpack('>i', header[4:])[0]
+        sums = fh.read()
+    expected = np.frombuffer(sums, dtype='>u4')
+    with open(part_file, 'rb') as fh:
+        for expected_sum in expected:
+            chunk = fh.read(bytes_per_sum)
+            if zlib.crc32(chunk) != expected_sum:
+                return False
+        if fh.read(1):  # more data than checksums
+            return False
+    return True
+
+
+def parse_part(part_file):
+    """
+    Parse one UserID::MovieID::Rating::Timestamp file into columns
+    :return: dict of column name -> 1d ndarray
+    """
+    with open(part_file, 'rb') as fh:
+        data = fh.read().replace(b'::', b' ')
+    fields = np.array(data.split(), dtype=np.float64).reshape(-1, len(COLUMNS))
+    return {name: fields[:, k].astype(COLUMN_DTYPES[name]) for k, name in enumerate(COLUMNS)}
+
+
+def _parse_part_checked(args):
+    part_file, check_crc = args
+    if check_crc and not verify_crc(part_file):
+        raise IOError("Checksum mismatch in %s" % part_file)
+    return parse_part(part_file)
+
+
+def default_cache_dir(ratings_path):
+    """
+    '_columns' inside a partitioned directory (ignored by Spark textFile), '<file>.columns' otherwise
+    """
+    if is_partitioned(ratings_path):
+        return os.path.join(ratings_path, '_columns')
+    return ratings_path + '.columns'
+
+
+def cache_is_fresh(cache_dir, source_files):
+    cache_files = [os.path.join(cache_dir, name + '.npy') for name in COLUMNS]
+    if not all(os.path.isfile(f) for f in cache_files):
+        return False
+    cache_time = min(os.path.getmtime(f) for f in cache_files)
+    return all(os.path.getmtime(f) <= cache_time for f in source_files)
+
+
+def save_columns(columns, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    for name in COLUMNS:
+        np.save(os.path.join(cache_dir, name + '.npy'), columns[name])
+
+
+def load_columns(cache_dir, mmap_mode='r'):
+    """
+    :return: dict of column name -> memory-mapped 1d ndarray
+    """
+    return {name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode=mmap_mode) for name in COLUMNS}
+
+
+def load_ratings_columns(ratings_path, n_workers=None, check_crc=False, cache_dir=None, use_cache=True):
+    """
+    Load ratings from a file or a partitioned directory into columns
+    :param ratings_path: ratings.dat file, or directory of part-0000N files
+    :param n_workers: worker processes for parsing parts, default os.cpu_count()
+    :param check_crc: validate the .crc sidecars of each part, also when the columns come from a fresh cache
+    :param cache_dir: where to keep the columnar cache, default is next to the data
+    :param use_cache: read/write the columnar cache
+    :return: dict of column name -> 1d ndarray ('user', 'item', 'rating', 'timestamp')
+    """
+    if is_partitioned(ratings_path):
+        parts = list_parts(ratings_path)
+    elif os.path.isfile(ratings_path):
+        parts = [ratings_path]
+    else:
+        raise IOError("File %s does not exist." % ratings_path)
+    if not parts:
+        raise IOError("No part files in %s." % ratings_path)
+
+    if cache_dir is None:
+        cache_dir = default_cache_dir(ratings_path)
+    if use_cache and cache_is_fresh(cache_dir, parts):
+        if check_crc:
+            for part in parts:
+                if not verify_crc(part):
+                    raise IOError("Checksum mismatch in %s" % part)
+        return load_columns(cache_dir)
+
+    tasks = [(part, check_crc) for part in parts]
+    if len(parts) == 1 or n_workers == 1:
+        chunks = list(map(_parse_part_checked, tasks))
+    else:
+        with Pool(processes=min(n_workers or os.cpu_count(), len(parts))) as pool:
+            chunks = pool.map(_parse_part_checked, tasks)  # keeps part order
+
+    columns = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in COLUMNS}
+    if use_cache:
+        save_columns(columns, cache_dir)
+        return load_columns(cache_dir)
+    return columns
+
+
+def columns_to_array(columns, dtype=None):
+    """
+    :param dtype: dtype of the array, default int like utils.load_ratings on a single file, float64 when the
+                  ratings are not whole numbers (the 10M dataset has half stars)
+    :return: ndarray, [i, j, rating, timestamp], same layout as utils.load_ratings
+    """
+    if dtype is None:
+        rating = np.asarray(columns['rating'])
+        dtype = int if np.all(rating == np.round(rating)) else np.float64
+    return np.column_stack([np.asarray(columns[name]).astype(dtype) for name in COLUMNS])
@@ -0,0 +1,150 @@
+"""
+top-K recommendations from factor matrices, numpy only
+    1. one matrix product scores a batch of users against every item
+    2. already-rated items are excluded with a packed bitset, n_items / 8 bytes per user
+    3. np.argpartition picks the top K per row, only those K are sorted
+    4. retrieve_top_k: batch job over every user, float32 contiguous item factors, GEMM into a reused score buffer,
+       seen items skipped through the user's CSR row, int32 ids / float32 scores, block size from a memory budget
+"""
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+
+def rated_bitset(users, items, n_users, n_items):
+    """
+    :param users, items: ids of the rated (user, item) pairs
+    :return: [n_users, ceil(n_items / 8)] uint8, bit order of np.packbits
+    """
+    users = np.asarray(users, dtype=np.int64)
+    items = np.asarray(items, dtype=np.int64)
+    bits = np.zeros((n_users, (n_items + 7) // 8), dtype=np.uint8)
+    np.bitwise_or.at(bits, (users, items >> 3), (128 >> (items & 7)).astype(np.uint8))
+    return bits
+
+
+def unpack_rated(bits, n_items):
+    """
+    :return: [n_users, n_items] bool
+    """
+    return np.unpackbits(bits, axis=-1, count=n_items).view(bool)
+
+
+def top_k(scores, k):
+    """
+    :param scores: [n_users, n_items]
+    :return: items [n_users, k], scores [n_users, k], best first
+    """
+    k = min(k, scores.shape[1])
+    idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-part, axis=1, kind='stable')
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+
+def recommend(user_factors, item_factors, users, k, rated_bits=None, candidates=None, batch_size=1024):
+    """
+    :param user_factors: [n_users, rank]
+    :param item_factors: [n_items, rank]
+    :param users: user ids to recommend for
+    :param rated_bits: rated_bitset, these items are never recommended
+    :param candidates: [n_items] bool, e.g. items the model knows, others are never recommended
+    :return: items [len(users), k], scores [len(users), k]; -inf scores mark padding when fewer than k items are left
+    """
+    users = np.asarray(users, dtype=np.int64)
+    n_items = item_factors.shape[0]
+    k = min(k, n_items)
+    items_out = np.zeros((users.shape[0], k), dtype=np.int64)
+    scores_out = np.zeros((users.shape[0], k), dtype=item_factors.dtype)
+    for lo in range(0, users.shape[0], batch_size):
+        batch = users[lo:lo + batch_size]
+        scores = user_factors[batch] @ item_factors.T
+        if candidates is not None:
+            scores[:, ~candidates] = -np.inf
+        if rated_bits is not None:
+            scores[unpack_rated(rated_bits[batch], n_items)] = -np.inf
+        items_out[lo:lo + batch.shape[0]], scores_out[lo:lo + batch.shape[0]] = top_k(scores, k)
+    return items_out, scores_out
+
+
+def hcf_factors(x, z, fill, w, h, beta=0.2):
+    """
+    HCF scores u * t_hat in factored form: u = concat(x, beta * y) with y = z + fill, t_hat = w * h
+    :param x, z, fill: cross_validation.build_xoz
+    :param w, h: factors of T, [2 * n_items, rank] and [rank, n_items]
+    :return: user_factors [n_users, rank], item_factors [n_items, rank], float32
+    """
+    n_items = h.shape[1]
+    w1, w2 = w[:n_items], w[n_items:]
+    user_factors = x @ w1 + beta * (z @ w2 + fill * w2.sum(axis=0))
+    return np.ascontiguousarray(user_factors, dtype=np.float32), np.ascontiguousarray(h.T, dtype=np.float32)
+
+
+def block_size_for_budget(n_items, memory_budget):
+    """
+    :param memory_budget: bytes for the per-block work arrays
+    :return: users per block: float32 score row, its negated copy and the int64 argpartition row per user
+    """
+    return max(1, int(memory_budget // (n_items * (4 + 4 + 8))))
+
+
+def exclude_csr(scores, seen, users):
+    """
+    Set scores[b, j] = -inf for every item j in the CSR row of users[b]
+    """
+    rows = seen[users]
+    block_rows = np.repeat(np.arange(users.shape[0]), np.diff(rows.indptr))
+    scores[block_rows, rows.indices] = -np.inf
+
+
+def retrieve_top_k(user_factors, item_factors, k, seen=None, users=None, memory_budget=256 * 2 ** 20):
+    """
+    :param user_factors: [n_users, rank]
+    :param item_factors: [n_items, rank]
+    :param seen: csr [n_users, n_items] of training items, never returned
+    :param users: ids to serve, default every user
+    :return: items [len(users), k] int32, scores [len(users), k] float32, -inf scores pad users with < k unseen items
+    """
+    item_factors = np.ascontiguousarray(item_factors, dtype=np.float32)
+    item_factors_t = item_factors.T
+    n_items = item_factors.shape[0]
+    users = np.arange(user_factors.shape[0]) if users is None else np.asarray(users, dtype=np.int64)
+    if seen is not None:
+        seen = csr_matrix(seen)
+    k = min(k, n_items)
+    block = block_size_for_budget(n_items, memory_budget)
+    items_out = np.empty((users.shape[0], k), dtype=np.int32)
+    scores_out = np.empty((users.shape[0], k), dtype=np.float32)
+    buffer = np.empty((min(block, users.shape[0]), n_items), dtype=np.float32)
+    for lo in range(0, users.shape[0], block):
+        batch = users[lo:lo + block]
+        scores = buffer[:batch.shape[0]]
+        np.matmul(np.asarray(user_factors[batch], dtype=np.float32), item_factors_t, out=scores)
+        if seen is not None:
+            exclude_csr(scores, seen, batch)
+        top_items, top_scores = top_k(scores, k)
+        items_out[lo:lo + batch.shape[0]] = top_items
+        scores_out[lo:lo + batch.shape[0]] = top_scores
+    return items_out, scores_out
+
+
+def top_k_dense(scores, k, seen=None, memory_budget=256 * 2 ** 20):
+    """
+    retrieve_top_k for an already completed score matrix (e.g. r_hat), processed in row blocks
+    :param scores: dense, or sparse (e.g. item_knn scores), densified one block at a time
+    :return: items [n_users, k] int32, scores [n_users, k] float32
+    """
+    n_users, n_items = scores.shape
+    if seen is not None:
+        seen = csr_matrix(seen)
+    k = min(k, n_items)
+    block = block_size_for_budget(n_items, memory_budget)
+    items_out = np.empty((n_users, k), dtype=np.int32)
+    scores_out = np.empty((n_users, k), dtype=np.float32)
+    for lo in range(0, n_users, block):
+        hi = min(lo + block, n_users)
+        block_scores = scores[lo:hi].toarray().astype(np.float32) if issparse(scores) \
+            else np.array(scores[lo:hi], dtype=np.float32)
+        if seen is not None:
+            exclude_csr(block_scores, seen, np.arange(lo, hi))
+        items_out[lo:hi], scores_out[lo:hi] = top_k(block_scores, k)
+    return items_out, scores_out
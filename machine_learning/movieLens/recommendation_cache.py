@@ -0,0 +1,144 @@
+"""
+per-user top-K cache in front of HCF / ALS retrieval
+    1. entries are keyed by (user, model version, k), LRU eviction beyond max_entries
+    2. a per-user key index makes invalidation O(entries of the changed users): new ratings drop only their users;
+       each invalidation bumps the user's generation, a result computed under an older generation is not stored
+    3. a model refresh bumps the version; entries of users whose factor rows did not change move to the new version
+    4. counters: hits, misses, evictions, invalidations, hit rate, hit / miss latency percentiles
+"""
+import threading
+from collections import OrderedDict, deque
+from time import perf_counter
+
+import numpy as np
+
+
+def changed_rows(old, new):
+    """
+    :return: row indices where the factors differ, every row when the shapes differ
+    """
+    if old.shape != new.shape:
+        return np.arange(new.shape[0])
+    return np.flatnonzero(np.any(np.asarray(old) != np.asarray(new), axis=1))
+
+
+class RecommendationCache(object):
+    # compute_fn(users ndarray, k) -> list of (items, scores), one entry per user, called for misses only
+    def __init__(self, compute_fn=None, max_entries=100000, model_version=0, latency_window=10000):
+        self.compute_fn = compute_fn
+        self.max_entries = max_entries
+        self.model_version = model_version
+        self.entries = OrderedDict()
+        self.user_keys = {}
+        self.generations = {}  # user -> number of invalidations, captured before computing a miss
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+        self.hit_latency = deque(maxlen=latency_window)
+        self.miss_latency = deque(maxlen=latency_window)
+
+    def _drop(self, key):
+        del self.entries[key]
+        keys = self.user_keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.user_keys[key[0]]
+
+    def generation(self, user):
+        return self.generations.get(user, 0)
+
+    def lookup(self, user, k):
+        """
+        :return: cached (items, scores) or None, counts a hit or a miss
+        """
+        start_time = perf_counter()
+        key = (user, self.model_version, k)
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+        self.hit_latency.append(perf_counter() - start_time)
+        return value
+
+    def store(self, user, k, value, seconds=None, model_version=None, generation=None):
+        """
+        :param seconds: time the miss took to compute, for the latency counters
+        :param model_version: version the value was computed with, stale values are not stored
+        :param generation: self.generation(user) captured before computing, the value is not stored if the user
+                           was invalidated in the meantime
+        """
+        if seconds is not None:
+            self.miss_latency.append(seconds)
+        with self.lock:
+            if model_version is not None and model_version != self.model_version:
+                return
+            if generation is not None and generation != self.generations.get(user, 0):
+                return
+            key = (user, self.model_version, k)
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.user_keys.setdefault(user, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+                self.counters['evictions'] += 1
+
+    def get_many(self, users, k):
+        """
+        :return: list of (items, scores) for users, misses are computed in one compute_fn call
+        """
+        results = [self.lookup(user, k) for user in users]
+        missing = sorted({user for user, value in zip(users, results) if value is None})
+        if missing:
+            version = self.model_version
+            generations = {user: self.generation(user) for user in missing}
+            start_time = perf_counter()
+            computed = dict(zip(missing, self.compute_fn(np.asarray(missing), k)))
+            seconds = (perf_counter() - start_time) / len(missing)
+            for user in missing:
+                self.store(user, k, computed[user], seconds, version, generations[user])
+            results = [computed[user] if value is None else value for user, value in zip(users, results)]
+        return results
+
+    def get(self, user, k):
+        return self.get_many([user], k)[0]
+
+    def invalidate_users(self, users):
+        """
+        Drop every entry of these users, e.g. after they rated something
+        """
+        with self.lock:
+            for user in users:
+                self.generations[user] = self.generations.get(user, 0) + 1
+                for key in list(self.user_keys.get(user, ())):
+                    self._drop(key)
+                    self.counters['invalidations'] += 1
+
+    def refresh_model(self, model_version, changed_users=None):
+        """
+        :param changed_users: users whose factor rows changed, None if everything changed (e.g. new item factors)
+        """
+        with self.lock:
+            old_version, self.model_version = self.model_version, model_version
+            changed = None if changed_users is None else set(int(u) for u in changed_users)
+            for key in list(self.entries):
+                user, version, k = key
+                value = self.entries[key]
+                self._drop(key)
+                if version != old_version or changed is None or user in changed:
+                    self.counters['invalidations'] += 1
+                    continue
+                new_key = (user, model_version, k)
+                self.entries[new_key] = value
+                self.user_keys.setdefault(user, set()).add(new_key)
+
+    def stats(self):
+        lookups = self.counters['hits'] + self.counters['misses']
+        stats = dict(self.counters, entries=len(self.entries), model_version=self.model_version,
+                     hit_rate=self.counters['hits'] / lookups if lookups else 0.)
+        for name, window in (('hit', self.hit_latency), ('miss', self.miss_latency)):
+            ms = np.asarray(window) * 1000
+            stats[name + '_p50_ms'] = float(np.percentile(ms, 50)) if ms.shape[0] else None
+            stats[name + '_p99_ms'] = float(np.percentile(ms, 99)) if ms.shape[0] else None
+        return stats
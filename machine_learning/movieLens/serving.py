@@ -0,0 +1,315 @@
+"""
+local recommendation scoring service, asyncio + stdlib HTTP/1.1 (keep-alive)
+    1. save_model writes factors, sorted raw id maps and the training CSR as .npy; load_model memory-maps them
+    2. GET /recommend?user=<id>&k=10: concurrent requests are coalesced into micro-batches (max_batch users or
+       max_delay_ms), each batch is one GEMM + argpartition (recommend.retrieve_top_k) in a worker thread
+    3. GET /score?user=<id>&items=<id>,<id>: dot products for the given items
+    4. POST /rate?user=<id>&item=<id>: the item is excluded from now on and the user's cached results are dropped
+    5. POST /reload: re-reads model_dir, only users whose factor or seen rows changed lose their cached results
+    6. result cache: recommendation_cache.RecommendationCache, keyed by (user, model version, k), counters in /stats
+run: python serving.py [model_dir] [port], load test with serving_load.py
+"""
+import sys
+import os
+import json
+import asyncio
+from time import perf_counter
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.decomposition import NMF
+
+
+def add_path(path):
+    if path not in sys.path:
+        print('Adding {}'.format(path))
+        sys.path.append(path)
+
+
+abs_current_path = os.path.realpath('./')
+root_path = os.path.join('/', *abs_current_path.split(os.path.sep)[:-2])
+add_path(root_path)
+
+from machine_learning.movieLens.cross_validation import prepare_holdout
+from machine_learning.movieLens.recommend import hcf_factors, retrieve_top_k
+from machine_learning.movieLens.recommendation_cache import RecommendationCache, changed_rows
+from machine_learning.movieLens.splits import mod_split, take
+from machine_learning.movieLens.utils import load_ratings
+
+MODEL_FILES = ('user_factors', 'item_factors', 'user_ids', 'item_ids', 'seen_indptr', 'seen_indices')
+
+
+def save_model(model_dir, user_factors, item_factors, seen, user_ids=None, item_ids=None):
+    """
+    :param seen: csr [n_users, n_items] training items, never recommended
+    :param user_ids, item_ids: raw id of every row, sorted; default row index
+    """
+    os.makedirs(model_dir, exist_ok=True)
+    seen = csr_matrix(seen)
+    arrays = {
+        'user_factors': np.ascontiguousarray(user_factors, dtype=np.float32),
+        'item_factors': np.ascontiguousarray(item_factors, dtype=np.float32),
+        'user_ids': np.arange(user_factors.shape[0]) if user_ids is None else np.asarray(user_ids),
+        'item_ids': np.arange(item_factors.shape[0]) if item_ids is None else np.asarray(item_ids),
+        'seen_indptr': seen.indptr.astype(np.int64),
+        'seen_indices': seen.indices.astype(np.int32),
+    }
+    for name in MODEL_FILES:
+        # write + rename: a running service keeps its memory maps of the old files until it reloads
+        path = os.path.join(model_dir, name + '.npy')
+        np.save(path + '.tmp.npy', arrays[name])
+        os.replace(path + '.tmp.npy', path)
+
+
+def load_model(model_dir):
+    """
+    :return: dict of memory-mapped arrays, nothing is copied until it is read
+    """
+    return {name: np.load(os.path.join(model_dir, name + '.npy'), mmap_mode='r') for name in MODEL_FILES}
+
+
+def lookup(sorted_ids, raw_ids):
+    """
+    :return: row indices of raw_ids, -1 where unknown
+    """
+    raw_ids = np.asarray(raw_ids)
+    pos = np.minimum(np.searchsorted(sorted_ids, raw_ids), sorted_ids.shape[0] - 1)
+    return np.where(sorted_ids[pos] == raw_ids, pos, -1)
+
+
+def seen_matrix(model):
+    n_users, n_items = model['user_factors'].shape[0], model['item_factors'].shape[0]
+    return csr_matrix((np.ones(model['seen_indices'].shape[0], dtype=np.int8), model['seen_indices'],
+                       model['seen_indptr']), shape=(n_users, n_items))
+
+
+def changed_users(old_model, new_model, old_seen, new_seen):
+    """
+    :return: user rows whose recommendations may differ under new_model, None if every user's may
+    """
+    if old_model['item_factors'].shape != new_model['item_factors'].shape or \
+            changed_rows(old_model['item_factors'], new_model['item_factors']).shape[0] or \
+            not np.array_equal(old_model['user_ids'], new_model['user_ids']) or \
+            not np.array_equal(old_model['item_ids'], new_model['item_ids']):
+        return None
+    rows = changed_rows(old_model['user_factors'], new_model['user_factors'])
+    if old_seen.shape == new_seen.shape:
+        rows = np.union1d(rows, np.unique((old_seen != new_seen).nonzero()[0]))
+    return rows
+
+
+class Recommender(object):
+    # scoring state of the service: mmap model, rating overlay, result cache, micro-batch queue
+    def __init__(self, model, max_batch=256, max_delay_ms=2., cache_size=100000, model_dir=None):
+        self.model = model
+        self.model_dir = model_dir
+        self.seen = seen_matrix(model)
+        self.new_ratings = {}  # user row -> set of item rows rated since the model was saved
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.cache = RecommendationCache(max_entries=cache_size)
+        self.queue = None
+        self.stats = {'requests': 0, 'batches': 0, 'batched_users': 0, 'reloads': 0}
+
+    def rate(self, user, item):
+        self.new_ratings.setdefault(user, set()).add(item)
+        self.cache.invalidate_users([user])
+
+    def load_changes(self):
+        """
+        runs in a worker thread: the model saved in model_dir and the users whose rows changed
+        """
+        model = load_model(self.model_dir)
+        seen = seen_matrix(model)
+        return model, seen, changed_users(self.model, model, self.seen, seen)
+
+    async def reload(self):
+        """
+        Swap in the model saved in model_dir, cached results survive for users whose rows did not change
+        :return: number of invalidated users, -1 for all
+        """
+        model, seen, users = await asyncio.get_running_loop().run_in_executor(None, self.load_changes)
+        self.model, self.seen = model, seen
+        self.cache.refresh_model(self.cache.model_version + 1, users)
+        self.stats['reloads'] += 1
+        return -1 if users is None else int(users.shape[0])
+
+    def top_k_batch(self, model, seen, new_ratings, users, k):
+        """
+        one GEMM for the whole micro-batch, runs in a worker thread
+        :param model, seen, new_ratings: snapshots taken on the event loop, rate / reload keep changing the originals
+        """
+        items, scores = retrieve_top_k(model['user_factors'], model['item_factors'],
+                                       k + max((len(new_ratings.get(u, ())) for u in users), default=0),
+                                       seen, users)
+        results = []
+        for row, user in enumerate(users):
+            extra = new_ratings.get(user, ())
+            keep = np.isfinite(scores[row]) & ~np.isin(items[row], list(extra))
+            results.append((items[row][keep][:k], scores[row][keep][:k]))
+        return results
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            by_k = {}
+            for user, k, future in batch:
+                by_k.setdefault(k, []).append((user, future))
+            for k, requests in by_k.items():
+                users = np.unique([user for user, _ in requests])
+                new_ratings = {user: frozenset(self.new_ratings[user]) for user in users.tolist()
+                               if user in self.new_ratings}
+                try:
+                    results = await loop.run_in_executor(None, self.top_k_batch, self.model, self.seen, new_ratings,
+                                                         users, k)
+                except Exception as e:  # fail this batch's requests, the loop keeps serving
+                    for _, future in requests:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                by_user = dict(zip(users.tolist(), results))
+                for user, future in requests:
+                    if not future.done():
+                        future.set_result(by_user[user])
+                self.stats['batches'] += 1
+                self.stats['batched_users'] += users.shape[0]
+
+    async def recommend(self, user, k):
+        self.stats['requests'] += 1
+        cached = self.cache.lookup(user, k)
+        if cached is not None:
+            return cached
+        model_version = self.cache.model_version
+        generation = self.cache.generation(user)  # a /rate while this is in flight keeps the result out of the cache
+        start_time = perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((user, k, future))
+        items, scores = await future
+        self.cache.store(user, k, (items, scores), perf_counter() - start_time, model_version, generation)
+        return items, scores
+
+    def score(self, user, items):
+        return self.model['item_factors'][items] @ self.model['user_factors'][user]
+
+
+async def handle_request(recommender, method, target):
+    """
+    :return: (status, json body)
+    """
+    url = urlsplit(target)
+    query = {key: values[0] for key, values in parse_qs(url.query).items()}
+    model = recommender.model
+    try:
+        user = int(lookup(model['user_ids'], [int(query['user'])])[0]) if 'user' in query else -1
+        if url.path == '/recommend' and method == 'GET':
+            if user < 0:
+                return 404, {'error': 'unknown user'}
+            k = int(query.get('k', 10))
+            if k < 1:
+                return 400, {'error': 'k must be >= 1'}
+            items, scores = await recommender.recommend(user, k)
+            return 200, {'user': int(query['user']), 'items': model['item_ids'][items].tolist(),
+                         'scores': scores.tolist()}
+        if url.path == '/score' and method == 'GET':
+            raw_items = [int(i) for i in query['items'].split(',')]
+            items = lookup(model['item_ids'], raw_items)
+            if user < 0 or (items < 0).any():
+                return 404, {'error': 'unknown user or item'}
+            return 200, {'user': int(query['user']), 'items': raw_items,
+                         'scores': recommender.score(user, items).tolist()}
+        if url.path == '/rate' and method == 'POST':
+            item = int(lookup(model['item_ids'], [int(query['item'])])[0])
+            if user < 0 or item < 0:
+                return 404, {'error': 'unknown user or item'}
+            recommender.rate(user, item)
+            return 200, {'ok': True}
+        if url.path == '/reload' and method == 'POST':
+            invalidated = await recommender.reload()
+            return 200, {'model_version': recommender.cache.model_version, 'invalidated_users': invalidated}
+        if url.path == '/stats':
+            return 200, dict(recommender.stats, cache=recommender.cache.stats())
+    except (KeyError, ValueError) as e:
+        return 400, {'error': 'bad request: {}'.format(e)}
+    except Exception as e:
+        return 500, {'error': '{}: {}'.format(type(e).__name__, e)}
+    return 404, {'error': 'not found'}
+
+
+async def serve_connection(recommender, reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            if int(headers.get('content-length', 0)):
+                await reader.readexactly(int(headers['content-length']))
+            status, body = await handle_request(recommender, method, target)
+            payload = json.dumps(body).encode()
+            writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+                status, 'OK' if status == 200 else 'Error', len(payload)).encode() + payload)
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run_server(model_dir, host='127.0.0.1', port=8080, **kwargs):
+    recommender = Recommender(load_model(model_dir), model_dir=model_dir, **kwargs)
+    recommender.queue = asyncio.Queue()
+    batcher = asyncio.create_task(recommender.batch_loop())
+    server = await asyncio.start_server(lambda r, w: serve_connection(recommender, r, w), host, port)
+    print('serving {} on http://{}:{}'.format(model_dir, host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher.cancel()
+
+
+def build_model(model_dir, rank=25, beta=0.2):
+    """
+    HCF factors (NMF of T) of the mod-10 training split, saved for the service
+    """
+    path = '../../data/movielens/medium/ratings.dat'
+    ratings = load_ratings(path)
+    train_idx, test_idx = mod_split(ratings[:, 3], 8)
+    fold = prepare_holdout(take(ratings, train_idx), take(ratings, test_idx), (6041, 3953))
+    model = NMF(n_components=rank, init='random', random_state=0, max_iter=200)
+    w = model.fit_transform(fold['t'])
+    user_factors, item_factors = hcf_factors(fold['x_train'], fold['z_train'], fold['fill'], w, model.components_,
+                                             beta)
+    save_model(model_dir, user_factors, item_factors, fold['x_train'])
+
+
+def main():
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else 'hcf_serving'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    if not os.path.exists(os.path.join(model_dir, 'user_factors.npy')):
+        build_model(model_dir)
+    asyncio.run(run_server(model_dir, port=port))
+
+
+if __name__ == "__main__":
+    main()
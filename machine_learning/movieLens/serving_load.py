@@ -0,0 +1,70 @@
+"""
+load generator for serving.py: concurrent keep-alive connections send /recommend (and /score) requests
+reports QPS and p50 / p90 / p99 latency
+run: python serving_load.py [port] [n_requests] [concurrency]
+"""
+import sys
+import asyncio
+from time import perf_counter
+
+import numpy as np
+
+
+async def http_get(reader, writer, target):
+    writer.write('GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(target).encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':')[1])
+    await reader.readexactly(length)
+    return status
+
+
+async def client(host, port, targets, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    for target in targets:
+        start_time = perf_counter()
+        status = await http_get(reader, writer, target)
+        latencies.append(perf_counter() - start_time)
+        if status != 200:
+            errors.append(status)
+    writer.close()
+
+
+async def run_load(host='127.0.0.1', port=8080, n_requests=10000, concurrency=64, n_users=6040, k=10,
+                   score_fraction=0.1, seed=0):
+    """
+    :return: dict(qps, p50_ms, p90_ms, p99_ms, errors)
+    """
+    rs = np.random.RandomState(seed)
+    users = rs.randint(1, n_users + 1, n_requests)
+    targets = ['/score?user={}&items={},{},{}'.format(u, *rs.randint(1, 3953, 3)) if rs.rand() < score_fraction
+               else '/recommend?user={}&k={}'.format(u, k) for u in users]
+    latencies, errors = [], []
+    start_time = perf_counter()
+    await asyncio.gather(*[client(host, port, targets[c::concurrency], latencies, errors)
+                           for c in range(concurrency)])
+    seconds = perf_counter() - start_time
+    ms = np.asarray(latencies) * 1000
+    report = {'qps': n_requests / seconds, 'p50_ms': np.percentile(ms, 50), 'p90_ms': np.percentile(ms, 90),
+              'p99_ms': np.percentile(ms, 99), 'errors': len(errors)}
+    print('{} requests, concurrency {}: {:.0f} QPS, p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms, {} errors'.format(
+        n_requests, concurrency, report['qps'], report['p50_ms'], report['p90_ms'], report['p99_ms'],
+        report['errors']))
+    return report
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    n_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+    asyncio.run(run_load(port=port, n_requests=n_requests, concurrency=concurrency))
+
+
+if __name__ == "__main__":
+    main()
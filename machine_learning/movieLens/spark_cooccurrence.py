@@ -0,0 +1,179 @@
+"""
+distributed compute_t on spark: T = concat(norm(X.T * X), norm(Y.T * X)), written as triples for ALS
+    1. Y is split like cross_validation.build_xoz: Y = Z + fill * ones, Z only has observed cells
+    2. 'pairs' mode: ratings are partitioned by user, each partition multiplies its own users' sparse rows
+       (sum over users of x_u.T * x_u) and emits item rows; 'blocks' mode: BlockMatrix multiplies
+    3. rows are summed per item, the fill * colsum(X) term is added from a broadcast
+    4. masked min-max (only t > 0) uses global min/max from one reduce, applied on the executors
+"""
+import numpy as np
+from scipy.sparse import csr_matrix
+from pyspark.mllib.linalg.distributed import CoordinateMatrix, MatrixEntry
+from pyspark.sql import SparkSession
+
+from machine_learning.movieLens.spark_io import TRIPLE_SCHEMA
+
+T1, T2 = 0, 1
+
+
+def xz_values(rating, binary=False):
+    """
+    :param rating: scalar or ndarray of ratings
+    :return: x, z, fill, see cross_validation.build_xoz
+    """
+    rating = np.asarray(rating, dtype=np.float64)
+    if binary:
+        x = (rating >= 3).astype(np.float64)
+        return x, 1 - x, 0.
+    return rating / 5, (6 - rating) / 5 - 6 / 5, 6 / 5
+
+
+def _partition_products(n_items, binary):
+    def products(rows):
+        rows = np.asarray([(row[0], row[1], row[2]) for row in rows], dtype=np.float64)
+        if rows.shape[0] == 0:
+            return
+        _, local_user = np.unique(rows[:, 0], return_inverse=True)
+        item = rows[:, 1].astype(np.int64)
+        x_val, z_val, _ = xz_values(rows[:, 2], binary)
+        shape = (local_user.max() + 1, n_items)
+        x = csr_matrix((x_val, (local_user, item)), shape=shape)
+        z = csr_matrix((z_val, (local_user, item)), shape=shape)
+        for tag, product in ((T1, (x.T @ x).tocsr()), (T2, (z.T @ x).tocsr())):
+            for i in np.flatnonzero(np.diff(product.indptr)):
+                lo, hi = product.indptr[i], product.indptr[i + 1]
+                yield (tag, int(i)), (product.indices[lo:hi], product.data[lo:hi])
+    return products
+
+
+def pair_rows(ratings, n_items, num_partitions, binary=False):
+    """
+    :param ratings: RDD of (user, item, rating)
+    :return: RDD of ((tag, i), (cols, values)) partial rows of x.T * x (tag T1) and z.T * x (tag T2)
+    """
+    return ratings.keyBy(lambda r: int(r[0])) \
+        .partitionBy(num_partitions) \
+        .values() \
+        .mapPartitions(_partition_products(n_items, binary))
+
+
+def block_rows(ratings, n_items, block_size=1024, binary=False):
+    """
+    Same output as pair_rows, computed with BlockMatrix.multiply
+    """
+    x_entries = ratings.map(lambda r: MatrixEntry(int(r[0]), int(r[1]), float(xz_values(r[2], binary)[0])))
+    z_entries = ratings.map(lambda r: MatrixEntry(int(r[0]), int(r[1]), float(xz_values(r[2], binary)[1])))
+    x = CoordinateMatrix(x_entries).toBlockMatrix(block_size, block_size)
+    z = CoordinateMatrix(z_entries).toBlockMatrix(block_size, block_size)
+    rows = []
+    for tag, product in ((T1, x.transpose().multiply(x)), (T2, z.transpose().multiply(x))):
+        rows.append(product.toCoordinateMatrix().entries
+                    .map(lambda e, tag=tag: ((tag, int(e.i)), (np.array([e.j]), np.array([e.value])))))
+    return rows[0].union(rows[1])
+
+
+def sum_rows(partial_rows, n_items, col_sum_bc, fill):
+    """
+    :return: RDD of ((tag, i), dense row [n_items]), T2 rows include fill * colsum(X)
+    """
+    def create(part):
+        row = np.zeros(n_items)
+        np.add.at(row, part[0], part[1])
+        return row
+
+    def merge(row, part):
+        np.add.at(row, part[0], part[1])
+        return row
+
+    def merge_rows(a, b):
+        a += b
+        return a
+
+    rows = partial_rows.combineByKey(create, merge, merge_rows)
+    if fill == 0:
+        return rows
+    # every T2 row gets fill * colsum(X), also rows without any z.T * x entry
+    all_t2 = partial_rows.context.range(n_items).map(lambda i: ((T2, int(i)), np.zeros(n_items)))
+    return rows.union(all_t2).reduceByKey(merge_rows) \
+        .map(lambda kv: (kv[0], kv[1] + fill * col_sum_bc.value if kv[0][0] == T2 else kv[1]))
+
+
+def masked_min_max_stats(rows):
+    """
+    :return: {tag: (min of t > 0, max of t > 0)}
+    """
+    def stats(kv):
+        positive = kv[1][kv[1] > 0]
+        if positive.shape[0] == 0:
+            return kv[0][0], (np.inf, -np.inf)
+        return kv[0][0], (positive.min(), positive.max())
+
+    return dict(rows.map(stats)
+                .reduceByKey(lambda a, b: (min(a[0], b[0]), max(a[1], b[1])))
+                .collect())
+
+
+def compute_t_spark(spark, ratings, n_items, num_partitions=None, mode='pairs', block_size=1024,
+                    binary=False, threshold=1e-6):
+    """
+    :param ratings: RDD of training (user, item, rating)
+    :param mode: 'pairs' (partitioned per-user products) or 'blocks' (BlockMatrix multiply)
+    :return: DataFrame of (user, item, rating) = (row of T, col of T, value > threshold), T is [2 * n_items, n_items]
+    """
+    sc = spark.sparkContext
+    if num_partitions is None:
+        num_partitions = sc.defaultParallelism * 2
+    fill = xz_values(0., binary)[2]
+    col_sum = np.zeros(n_items)
+    for item, value in ratings.map(lambda r: (int(r[1]), float(xz_values(r[2], binary)[0]))) \
+            .reduceByKey(lambda a, b: a + b).collect():
+        col_sum[item] = value
+    col_sum_bc = sc.broadcast(col_sum)
+
+    if mode == 'pairs':
+        partial_rows = pair_rows(ratings, n_items, num_partitions, binary)
+    elif mode == 'blocks':
+        partial_rows = block_rows(ratings, n_items, block_size, binary)
+    else:
+        raise ValueError("mode must be 'pairs' or 'blocks', got %s" % mode)
+
+    rows = sum_rows(partial_rows, n_items, col_sum_bc, fill).persist()
+    stats_bc = sc.broadcast(masked_min_max_stats(rows))
+
+    def to_triples(kv):
+        (tag, i), row = kv
+        t_min, t_max = stats_bc.value[tag]
+        mask = row > 0
+        row_norm = (row - t_min) / (t_max - t_min) * mask
+        cols = np.flatnonzero(row_norm > threshold)
+        offset = tag * n_items  # T2 rows come after T1 rows
+        return [(int(offset + i), int(j), float(row_norm[j])) for j in cols]
+
+    return spark.createDataFrame(rows.flatMap(to_triples), schema=TRIPLE_SCHEMA)
+
+
+def parse_training_rating(line):
+    """
+    userId::movieId::rating::timestamp -> (last digit of timestamp, (user, item, rating))
+    """
+    fields = line.strip().split("::")
+    return int(fields[3]) % 10, (int(fields[0]), int(fields[1]), float(fields[2]))
+
+
+def main():
+    spark = SparkSession.builder \
+        .master('local[*]') \
+        .getOrCreate()
+    path = '../../data/movielens/medium/ratings.dat'
+    training = spark.sparkContext.textFile(path) \
+        .map(parse_training_rating) \
+        .filter(lambda x: x[0] < 8) \
+        .values()  # same rows as split_ratings(ratings, 8)
+    t = compute_t_spark(spark, training, 3953)
+    t.write.mode('overwrite').parquet('hcf_t.parquet')  # spark_io.read_triples_parquet, then ALS
+    print("T has {} entries".format(t.count()))
+    spark.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+shuffle-free evaluation of an ALS model (mllib or pyspark.ml)
+    1. user and item factors are streamed to the driver once (spark_io.collect_factors) and broadcast
+    2. each test partition scores its own (user, item, label) rows with one vectorized dot
+    3. (score, label) pairs go straight into BinaryClassificationMetrics, no predictAll + join
+"""
+import numpy as np
+from pyspark.mllib.evaluation import BinaryClassificationMetrics
+
+from machine_learning.movieLens.spark_io import collect_factors, model_features
+
+
+def local_factors(features_rdd, rank, n_rows=None):
+    """
+    :param n_rows: at least max id + 1, to pad the factors to a fixed number of users / items
+    :return: factors [n_rows, rank] float32, known [n_rows] bool
+    """
+    ids = np.asarray(features_rdd.keys().collect(), dtype=np.int64)
+    if n_rows is None:
+        n_rows = int(ids.max()) + 1
+    known = np.zeros(n_rows, dtype=bool)
+    known[ids] = True
+    return collect_factors(features_rdd, n_rows, rank), known
+
+
+def broadcast_factors(sc, features_rdd, rank):
+    """
+    :return: broadcast of (factors [max id + 1, rank] float32, known [max id + 1] bool)
+    """
+    return sc.broadcast(local_factors(features_rdd, rank))
+
+
+def broadcast_scores_and_labels(model, data):
+    """
+    :param model: MatrixFactorizationModel or ALSModel, see spark_io.model_features
+    :param data: RDD of (user, item, label)
+    :return: RDD of (score, label); pairs with a user or item unseen in training are dropped, like predictAll
+    """
+    sc = data.context
+    user_features, item_features = model_features(model)
+    users_bc = broadcast_factors(sc, user_features, model.rank)
+    items_bc = broadcast_factors(sc, item_features, model.rank)
+
+    def score_partition(rows):
+        rows = np.asarray([(row[0], row[1], row[2]) for row in rows], dtype=np.float64)
+        if rows.shape[0] == 0:
+            return iter([])
+        user_factors, user_known = users_bc.value
+        item_factors, item_known = items_bc.value
+        user = rows[:, 0].astype(np.int64)
+        item = rows[:, 1].astype(np.int64)
+        keep = (user < user_known.shape[0]) & (item < item_known.shape[0])
+        keep[keep] = user_known[user[keep]] & item_known[item[keep]]
+        user, item, label = user[keep], item[keep], rows[keep, 2]
+        scores = np.einsum('ij,ij->i', user_factors[user], item_factors[item])
+        return zip(scores.tolist(), label.tolist())
+
+    return data.mapPartitions(score_partition)
+
+
+def broadcast_auc(model, data):
+    """
+    :return: area under ROC, area under PR
+    """
+    metrics = BinaryClassificationMetrics(broadcast_scores_and_labels(model, data))
+    return metrics.areaUnderROC, metrics.areaUnderPR
@@ -0,0 +1,187 @@
+"""
+move numpy triples (i, j, value) into spark without sc.parallelize(list_of_tuples)
+    1. DataFrame from numpy columns through Arrow
+    2. or partitioned Parquet written with pyarrow and read by spark directly
+    3. partition counts follow the cluster cores instead of a hard-coded 2
+    4. ALS factors go back out without collect(): streamed per partition, written as Parquet, or scored on executors
+       (export_factors_and_scores: w, h and t_hat = w * h.T written by the executors, only [n, rank] on the driver)
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyspark.ml.recommendation import ALS
+from pyspark.sql.types import StructType, StructField, IntegerType, FloatType
+
+TRIPLE_SCHEMA = StructType([
+    StructField('user', IntegerType(), False),
+    StructField('item', IntegerType(), False),
+    StructField('rating', FloatType(), False),
+])
+
+
+def dense_to_triples(t, threshold=1e-6):
+    """
+    Vectorized parse_t: entries of t > threshold as (rows, cols, values) arrays
+    """
+    rows, cols = np.nonzero(t > threshold)
+    return rows.astype(np.int32), cols.astype(np.int32), t[rows, cols].astype(np.float32)
+
+
+def default_num_partitions(sc, per_core=2):
+    """
+    :return: partitions for the triples, a few per core the cluster offers
+    """
+    return max(1, sc.defaultParallelism * per_core)
+
+
+def triples_to_dataframe(spark, rows, cols, values, num_partitions=None):
+    """
+    Build a (user, item, rating) DataFrame from numpy arrays, columns are shipped as Arrow batches
+    :return: DataFrame, usable by pyspark.ml ALS and by mllib ALS.train
+    """
+    spark.conf.set('spark.sql.execution.arrow.pyspark.enabled', 'true')
+    pdf = pd.DataFrame({
+        'user': np.asarray(rows, dtype=np.int32),
+        'item': np.asarray(cols, dtype=np.int32),
+        'rating': np.asarray(values, dtype=np.float32),
+    })
+    df = spark.createDataFrame(pdf, schema=TRIPLE_SCHEMA)
+    if num_partitions is None:
+        num_partitions = default_num_partitions(spark.sparkContext)
+    return df.repartition(num_partitions)
+
+
+def triples_to_parquet(path, rows, cols, values, num_files):
+    """
+    Write the triples as num_files Parquet parts, read them back with read_triples_parquet(spark, path)
+    """
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):  # parts of an earlier write with more files
+        if name.startswith('part-'):
+            os.remove(os.path.join(path, name))
+    bounds = np.linspace(0, len(rows), num_files + 1).astype(np.int64)
+    for k in range(num_files):
+        lo, hi = bounds[k], bounds[k + 1]
+        table = pa.table({
+            'user': pa.array(np.asarray(rows[lo:hi], dtype=np.int32)),
+            'item': pa.array(np.asarray(cols[lo:hi], dtype=np.int32)),
+            'rating': pa.array(np.asarray(values[lo:hi], dtype=np.float32)),
+        })
+        pq.write_table(table, os.path.join(path, 'part-%05d.parquet' % k))
+
+
+def read_triples_parquet(spark, path):
+    return spark.read.schema(TRIPLE_SCHEMA).parquet(path)
+
+
+def als_ml_fit(df, rank, max_iter, reg_param, num_blocks=None, nonnegative=True, seed=999,
+               implicit=False, alpha=1.0, checkpoint_interval=10):
+    """
+    pyspark.ml ALS on a (user, item, rating) DataFrame, one ALS block per partition by default
+    :param implicit: implicitPrefs, df must then hold the observed user x item cells with confidence magnitudes
+                     (als.confidence_triples), not T
+    :param checkpoint_interval: iterations between factor checkpoints, only used once sc.setCheckpointDir is set
+    :return: ALSModel
+    """
+    if num_blocks is None:
+        num_blocks = df.rdd.getNumPartitions()
+    als = ALS(rank=rank, maxIter=max_iter, regParam=reg_param, nonnegative=nonnegative, seed=seed,
+              userCol='user', itemCol='item', ratingCol='rating',
+              numUserBlocks=num_blocks, numItemBlocks=num_blocks, coldStartStrategy='drop',
+              implicitPrefs=implicit, alpha=alpha, checkpointInterval=checkpoint_interval)
+    return als.fit(df)
+
+
+def model_features(model):
+    """
+    :param model: mllib MatrixFactorizationModel (or spark_partitioning.BlockBalancedModel) or pyspark.ml ALSModel
+    :return: user, item factor RDDs of (id, features)
+    """
+    if hasattr(model, 'userFeatures'):
+        return model.userFeatures(), model.productFeatures()
+    return model.userFactors.rdd.map(tuple), model.itemFactors.rdd.map(tuple)
+
+
+def _stack_partition(rows):
+    """
+    (id, features) rows of one partition -> a single (ids, [n, rank] float32 block)
+    """
+    rows = list(rows)
+    if rows:
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        yield ids, np.asarray([row[1] for row in rows], dtype=np.float32)
+
+
+def collect_factors(features_rdd, n_rows, rank, dtype=np.float32):
+    """
+    Stream model.userFeatures() / productFeatures() into a preallocated array, one partition at a time
+    :return: [n_rows, rank], rows of ids the model never saw are 0
+    """
+    factors = np.zeros((n_rows, rank), dtype=dtype)
+    for ids, block in features_rdd.mapPartitions(_stack_partition).toLocalIterator():
+        factors[ids] = block
+    return factors
+
+
+def factors_to_parquet(features_rdd, path):
+    """
+    Executors write (id, features) as Parquet, nothing passes through the driver
+    """
+    features_rdd.map(lambda row: (int(row[0]), [float(v) for v in row[1]])) \
+        .toDF(['id', 'features']) \
+        .write.mode('overwrite').parquet(path)
+
+
+def read_factors_parquet(path, n_rows, rank, dtype=np.float32):
+    """
+    :return: [n_rows, rank] factors from factors_to_parquet, 0 for missing ids
+    """
+    table = pq.read_table(path, columns=['id', 'features'])
+    factors = np.zeros((n_rows, rank), dtype=dtype)
+    ids = table.column('id').to_numpy()
+    values = table.column('features').combine_chunks().flatten().to_numpy()
+    factors[ids] = values.reshape(-1, rank)
+    return factors
+
+
+def score_blocks(sc, user_features_rdd, item_factors):
+    """
+    Fully distributed completion: item factors are broadcast, every partition of user factors scores
+    its own block of t_hat = user * item.T on the executor
+    :return: RDD of (user ids, [n, n_items] float32 scores)
+    """
+    items_bc = sc.broadcast(np.ascontiguousarray(item_factors, dtype=np.float32))
+
+    def score(rows):
+        for ids, block in _stack_partition(rows):
+            yield ids, block @ items_bc.value.T
+
+    return user_features_rdd.mapPartitions(score)
+
+
+def scores_to_parquet(blocks_rdd, path):
+    """
+    Executors write the score_blocks output as (id, scores) rows, one row of t_hat per id
+    """
+    blocks_rdd.flatMap(lambda block: ((int(i), row.tolist()) for i, row in zip(*block))) \
+        .toDF(['id', 'scores']) \
+        .write.mode('overwrite').parquet(path)
+
+
+def export_factors_and_scores(sc, model, n_rows, n_items, rank, out_dir):
+    """
+    Fully distributed completion: out_dir/w, out_dir/h (factors) and out_dir/t_hat (w * h.T, one row per id) are
+    written by the executors, the dense t_hat never reaches the driver
+    :param model: see model_features
+    :return: w [n_rows, rank], h [n_items, rank] float32, for scoring in factored form
+    """
+    user_features, item_features = model_features(model)
+    factors_to_parquet(user_features, os.path.join(out_dir, 'w'))
+    factors_to_parquet(item_features, os.path.join(out_dir, 'h'))
+    w = collect_factors(user_features, n_rows, rank)
+    h = collect_factors(item_features, n_items, rank)
+    scores_to_parquet(score_blocks(sc, user_features, h), os.path.join(out_dir, 't_hat'))
+    return w, h
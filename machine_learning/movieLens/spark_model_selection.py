@@ -0,0 +1,262 @@
+"""
+parallel spark ALS model selection
+    1. the training RDD is persisted once at a chosen storage level
+    2. grid points are submitted as concurrent spark jobs from a driver thread pool (use spark.scheduler.mode=FAIR)
+    3. each point is scored with spark_eval.broadcast_auc (no shuffle join)
+    4. per grid point: wall time plus job / stage / task counts from the status tracker
+    5. with a checkpoint dir, ALS lineage is truncated periodically; each finished point saves its model and
+       appends to a json lines results store, a restarted grid skips the points already in the store; store and
+       model dir are namespaced by explicit / implicit mode and a fingerprint of the training and validation data,
+       and only points of the current grid are resumed
+    6. implicit: ALS.trainImplicit on the observed user x item cells O with x + beta * y confidence magnitudes
+       (get_confidence_triples), scored on the held-out user x item cells; run: python spark_model_selection.py implicit
+"""
+import sys
+import os
+import itertools
+import json
+import hashlib
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import numpy as np
+from pyspark import StorageLevel
+from pyspark.mllib.recommendation import ALS, MatrixFactorizationModel
+from pyspark.sql import SparkSession
+
+
+def add_path(path):
+    if path not in sys.path:
+        print('Adding {}'.format(path))
+        sys.path.append(path)
+
+
+abs_current_path = os.path.realpath('./')
+root_path = os.path.join('/', *abs_current_path.split(os.path.sep)[:-2])
+add_path(root_path)
+
+from machine_learning.movieLens.als import confidence_triples
+from machine_learning.movieLens.cross_validation import prepare_holdout
+from machine_learning.movieLens.MovieLens_spark_hcf import get_triples
+from machine_learning.movieLens.MovieLens_sklearn_hcf_nn import split_ratings_by_time
+from machine_learning.movieLens.utils import load_ratings
+from machine_learning.movieLens.spark_eval import broadcast_auc
+from machine_learning.movieLens.spark_io import default_num_partitions, triples_to_dataframe
+
+
+def persist_training(rdd, storage_level=StorageLevel.MEMORY_AND_DISK):
+    """
+    Persist and materialize the training data once, every grid point then reads the cached blocks
+    """
+    rdd = rdd.persist(storage_level)
+    rdd.count()
+    return rdd
+
+
+def job_group_metrics(sc, group):
+    """
+    :return: dict of jobs, stages, tasks, failed_tasks run under the job group
+    """
+    tracker = sc.statusTracker()
+    metrics = {'jobs': 0, 'stages': 0, 'tasks': 0, 'failed_tasks': 0}
+    for job_id in tracker.getJobIdsForGroup(group):
+        job = tracker.getJobInfo(job_id)
+        if job is None:
+            continue
+        metrics['jobs'] += 1
+        for stage_id in job.stageIds:
+            stage = tracker.getStageInfo(stage_id)
+            if stage is None:
+                continue
+            metrics['stages'] += 1
+            metrics['tasks'] += stage.numTasks
+            metrics['failed_tasks'] += stage.numFailedTasks
+    return metrics
+
+
+def grid_point_id(rank, lmbda, num_iter, implicit=False, alpha=1.0):
+    point = 'als_rank{}_lambda{}_iter{}'.format(rank, lmbda, num_iter)
+    if implicit:
+        point += '_implicit{}'.format(alpha)
+    return point
+
+
+def data_fingerprint(*arrays):
+    """
+    :return: short hash of the training / validation arrays, another data set or split gets its own results store
+    """
+    digest = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        digest.update(str(a.shape).encode() + str(a.dtype).encode() + a.tobytes())
+    return digest.hexdigest()[:12]
+
+
+def namespace_paths(model_dir, results_file, implicit, fingerprint=None):
+    """
+    :return: model_dir / results_file of this mode and data, e.g. als_models/implicit_<fp>, als_grid_implicit_<fp>.jsonl
+    """
+    run = 'implicit' if implicit else 'explicit'
+    if fingerprint is not None:
+        run += '_' + fingerprint
+    if model_dir is not None:
+        model_dir = os.path.join(model_dir, run)
+    if results_file is not None:
+        root, ext = os.path.splitext(results_file)
+        results_file = '{}_{}{}'.format(root, run, ext)
+    return model_dir, results_file
+
+
+def enable_checkpointing(sc, checkpoint_dir):
+    """
+    Set the RDD checkpoint dir. mllib ALS then checkpoints its factor RDDs every 10 iterations (its
+    checkpointInterval, not exposed by the python ALS.train), spark_io.als_ml_fit takes checkpoint_interval
+    """
+    if checkpoint_dir is not None:
+        sc.setCheckpointDir(checkpoint_dir)
+
+
+def load_results(results_file):
+    """
+    :return: {grid point id: result} of the points finished in earlier runs
+    """
+    results = {}
+    if results_file is not None and os.path.exists(results_file):
+        with open(results_file) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    results[result['point']] = result
+    return results
+
+
+def save_result(results_file, result, lock):
+    record = {key: value for key, value in result.items() if key != 'model'}
+    with lock, open(results_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def fit_and_evaluate(sc, t_rdd, valid_rdd, rank, lmbda, num_iter, seed=999, implicit=False, alpha=1.0,
+                     model_dir=None):
+    """
+    Train one grid point in its own job group and score it on valid_rdd
+    :param implicit: ALS.trainImplicit, t_rdd must then hold the observed user x item cells with confidence
+                     magnitudes (get_confidence_triples), not T
+    :param model_dir: if given, the model (user and product factors) is saved under model_dir/<point id>
+    :return: dict(point, rank, lambda, num_iter, auc, seconds, model, model_path, jobs, stages, tasks,
+             failed_tasks)
+    """
+    group = grid_point_id(rank, lmbda, num_iter, implicit, alpha)
+    sc.setJobGroup(group, 'ALS grid point {}'.format(group))
+    start_time = time()
+    if implicit:
+        model = ALS.trainImplicit(t_rdd, rank, num_iter, lmbda, alpha=alpha, nonnegative=True, seed=seed)
+    else:
+        model = ALS.train(t_rdd, rank, num_iter, lmbda, nonnegative=True, seed=seed)
+    auc, _ = broadcast_auc(model, valid_rdd)
+    model_path = None
+    if model_dir is not None:
+        model_path = os.path.join(model_dir, group)
+        if os.path.exists(model_path):
+            shutil.rmtree(model_path)  # left over by a run that died while saving
+        model.save(sc, model_path)
+    result = {'point': group, 'rank': rank, 'lambda': lmbda, 'num_iter': num_iter, 'auc': auc,
+              'seconds': time() - start_time, 'model': model, 'model_path': model_path}
+    result.update(job_group_metrics(sc, group))
+    return result
+
+
+def parallel_grid_search(sc, t_rdd, valid_rdd, ranks, lambdas, num_iters, max_workers=4,
+                         storage_level=StorageLevel.MEMORY_AND_DISK, implicit=False, alpha=1.0,
+                         checkpoint_dir=None, model_dir=None, results_file=None, fingerprint=None):
+    """
+    :param checkpoint_dir: RDD checkpoint dir, truncates ALS lineage on long runs
+    :param model_dir: where every finished grid point saves its model, a subdir per mode and fingerprint
+    :param results_file: json lines results store, one file per mode and fingerprint; points of this grid already
+                         in it are not trained again
+    :param fingerprint: data_fingerprint of the training and validation data
+    :return: results of every point of this grid, best AUC first; resumed points are loaded from model_path
+    """
+    enable_checkpointing(sc, checkpoint_dir)
+    model_dir, results_file = namespace_paths(model_dir, results_file, implicit, fingerprint)
+    grid = {grid_point_id(rank, lmbda, num_iter, implicit, alpha): (rank, lmbda, num_iter)
+            for rank, lmbda, num_iter in itertools.product(ranks, lambdas, num_iters)}
+    done = {point: result for point, result in load_results(results_file).items() if point in grid}
+    points = [grid[point] for point in grid if point not in done]
+    print("{} grid points done in earlier runs, {} to train".format(len(done), len(points)))
+
+    t_rdd = persist_training(t_rdd, storage_level)
+    valid_rdd = persist_training(valid_rdd, storage_level)
+    lock = threading.Lock()
+
+    def run(rank, lmbda, num_iter):
+        result = fit_and_evaluate(sc, t_rdd, valid_rdd, rank, lmbda, num_iter, implicit=implicit, alpha=alpha,
+                                  model_dir=model_dir)
+        if results_file is not None:
+            save_result(results_file, result, lock)
+        return result
+
+    start_time = time()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # pinned thread mode (default since spark 3.2): each driver thread keeps its own job group
+        futures = [pool.submit(run, rank, lmbda, num_iter) for rank, lmbda, num_iter in points]
+        results = [future.result() for future in futures]
+    total = time() - start_time
+
+    for result in done.values():
+        if result['model_path'] is not None:
+            result['model'] = MatrixFactorizationModel.load(sc, result['model_path'])
+        results.append(result)
+
+    for r in results:
+        print("rank = {}, lambda = {}, numIter = {}: AUC {:.4f}, {:.1f}s, {} jobs, {} stages, {} tasks "
+              "({} failed)".format(r['rank'], r['lambda'], r['num_iter'], r['auc'], r['seconds'], r['jobs'],
+                                   r['stages'], r['tasks'], r['failed_tasks']))
+    print("{} grid points in {:.1f}s wall time, {:.1f}s summed over points".format(
+        len(results), total, sum(r['seconds'] for r in results)))
+    return sorted(results, key=lambda r: r['auc'], reverse=True)
+
+
+def get_confidence_triples(beta=0.2):
+    """
+    implicit training data: O of the time split as (user, item, x + beta * y), test cells as (user, item, label)
+    """
+    path = '../../data/movielens/medium/ratings.dat'
+    training, test = split_ratings_by_time(load_ratings(path), 0.8)
+    fold = prepare_holdout(training, test, (6041, 3953))
+    rows, cols, values = confidence_triples(fold['x_train'], fold['z_train'], fold['fill'], beta)
+    return (rows, cols, values), (fold['test_user'], fold['test_item'], fold['y_true'])
+
+
+def main():
+    implicit = len(sys.argv) > 1 and sys.argv[1] == 'implicit'
+    if implicit:
+        (rows, cols, values), test = get_confidence_triples()
+    else:
+        (rows, cols, values), test, o_train, x_train = get_triples()
+        test = (test[:, 0], test[:, 1], test[:, 2])
+    spark = SparkSession.builder \
+        .master('local[*]') \
+        .config("spark.scheduler.mode", "FAIR") \
+        .getOrCreate()
+    sc = spark.sparkContext
+
+    num_partitions = default_num_partitions(sc)
+    t_rdd = triples_to_dataframe(spark, rows, cols, values, num_partitions).rdd
+    test_rdd = triples_to_dataframe(spark, *test, num_partitions=num_partitions).rdd
+    results = parallel_grid_search(sc, t_rdd, test_rdd, ranks=[12, 16], lambdas=[0.1, 0.01], num_iters=[10, 20],
+                                   implicit=implicit, alpha=10.0, checkpoint_dir='als_checkpoints',
+                                   model_dir='als_models', results_file='als_grid.jsonl',
+                                   fingerprint=data_fingerprint(rows, cols, values, *test))
+    best = results[0]
+    print("The best model was trained with rank = {} and lambda = {}, and numIter = {}, and its AUC is {}".format(
+        best['rank'], best['lambda'], best['num_iter'], best['auc']))
+    sc.stop()
+
+
+if __name__ == "__main__":
+    main()
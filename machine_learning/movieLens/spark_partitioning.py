@@ -0,0 +1,79 @@
+"""
+skew-aware ALS blocking of T triples, popular items have dense T1 / T2 rows and ALS puts id k into block k % n_blocks
+(a HashPartitioner in mllib and pyspark.ml alike), so a few dense ids make straggler blocks
+    1. per-id nonzero counts come from the numpy triples on the driver, no extra pass over the RDD
+    2. ids are relabeled greedily (largest first, into the block with the fewest nonzeros so far), new id =
+       block + n_blocks * slot, so new_id % n_blocks spreads the nonzeros evenly over the ALS blocks
+    3. ALS trains on the relabeled triples, BlockBalancedModel maps the factors back to the original ids
+    4. nonzeros per ALS block are reported as a histogram plus the max / mean ratio (straggler factor)
+"""
+import heapq
+
+import numpy as np
+
+from machine_learning.movieLens.spark_io import model_features
+
+
+def block_relabeling(ids, n_blocks, n_ids=None):
+    """
+    :param ids: 1d user (or item) id of every training triple
+    :param n_ids: ids are 0 .. n_ids - 1, default max id + 1; ids without triples get a new id as well
+    :return: to_new [n_ids], new id of every id, ALS block to_new % n_blocks
+    """
+    counts = np.bincount(np.asarray(ids, dtype=np.int64), minlength=n_ids or 0)
+    to_new = np.empty(counts.shape[0], dtype=np.int64)
+    heap = [(0, 0, block) for block in range(n_blocks)]  # (nonzeros, slots, block)
+    for k in np.argsort(-counts, kind='stable'):
+        load, slots, block = heapq.heappop(heap)
+        to_new[k] = block + n_blocks * slots
+        heapq.heappush(heap, (load + int(counts[k]), slots + 1, block))
+    return to_new
+
+
+def restore_ids(features_rdd, to_new):
+    """
+    :param features_rdd: (new id, features) rows, e.g. model.userFeatures() of a model trained on relabeled ids
+    :return: (original id, features) rows
+    """
+    from_new = np.full(int(to_new.max()) + 1, -1, dtype=np.int64)
+    from_new[to_new] = np.arange(to_new.shape[0])
+    from_new_bc = features_rdd.context.broadcast(from_new)
+    return features_rdd.map(lambda row: (int(from_new_bc.value[row[0]]), row[1]))
+
+
+class BlockBalancedModel(object):
+    # ALS model (mllib or pyspark.ml) trained on block_relabeling ids, userFeatures / productFeatures are in the
+    # original ids again
+    def __init__(self, model, user_to_new, item_to_new):
+        self.model = model
+        self.rank = model.rank
+        self.user_to_new = user_to_new
+        self.item_to_new = item_to_new
+
+    def userFeatures(self):
+        return restore_ids(model_features(self.model)[0], self.user_to_new)
+
+    def productFeatures(self):
+        return restore_ids(model_features(self.model)[1], self.item_to_new)
+
+
+def block_loads(ids, n_blocks):
+    """
+    :return: nonzeros of every ALS block, [n_blocks]
+    """
+    return np.bincount(np.asarray(ids, dtype=np.int64) % n_blocks, minlength=n_blocks)
+
+
+def report_blocks(ids, n_blocks, name='ids', bins=10):
+    """
+    Print a histogram of the nonzeros per ALS block
+    :return: loads [n_blocks]
+    """
+    loads = block_loads(ids, n_blocks)
+    hist, edges = np.histogram(loads, bins=bins)
+    print("{}: {} blocks, {} nonzeros, min {} / median {:.0f} / max {}, max/mean {:.2f}".format(
+        name, loads.shape[0], loads.sum(), loads.min(), np.median(loads), loads.max(),
+        loads.max() / max(loads.mean(), 1)))
+    for count, lo, hi in zip(hist, edges[:-1], edges[1:]):
+        print("    [{:>10.0f}, {:>10.0f}) {}".format(lo, hi, '#' * int(count)))
+    return loads
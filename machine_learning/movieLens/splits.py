@@ -0,0 +1,105 @@
+"""
+vectorized train/test splits of the ratings
+    1. every split returns index arrays (train_idx, test_idx), no copies of the ratings
+    2. global time, timestamp mod 10, per-user leave-last-k, k-fold
+    3. k-fold: reorder the columns once, then every test fold is a contiguous (zero-copy) slice
+"""
+import numpy as np
+
+
+def time_split(timestamp, b1):
+    """
+    :param timestamp: 1d timestamps, one per rating
+    :param b1: fraction of the (oldest) ratings used for training
+    :return: train_idx, test_idx
+    """
+    order = np.argsort(timestamp, kind='stable')
+    n_train = int(order.shape[0] * b1)
+    return order[:n_train], order[n_train:]
+
+
+def mod_split(timestamp, b1):
+    """
+    :param timestamp: 1d timestamps, one per rating
+    :param b1: last digit of the timestamp < b1 goes to training, [b1, 9] to test
+    :return: train_idx, test_idx
+    """
+    is_train = np.asarray(timestamp) % 10 < b1
+    return np.flatnonzero(is_train), np.flatnonzero(~is_train)
+
+
+def leave_last_k(user, timestamp, k):
+    """
+    For every user the k most recent ratings go to test, users with <= k ratings keep one in training
+    :param user: 1d user ids, one per rating
+    :param timestamp: 1d timestamps, one per rating
+    :param k: number of held out ratings per user
+    :return: train_idx, test_idx
+    """
+    order = np.lexsort((timestamp, user))  # by user, then time
+    sorted_user = np.asarray(user)[order]
+    starts = np.flatnonzero(np.r_[True, sorted_user[1:] != sorted_user[:-1]])
+    counts = np.diff(np.r_[starts, sorted_user.shape[0]])
+    rank = np.arange(sorted_user.shape[0]) - np.repeat(starts, counts)  # position within the user
+    n_test = np.repeat(np.minimum(k, counts - 1), counts)
+    is_test = rank >= np.repeat(counts, counts) - n_test
+    return order[~is_test], order[is_test]
+
+
+def kfold(n_ratings, k, seed=0):
+    """
+    :return: order: permutation of the ratings, bounds: k + 1 offsets, fold f is order[bounds[f]:bounds[f + 1]]
+    """
+    order = np.random.RandomState(seed).permutation(n_ratings)
+    bounds = np.linspace(0, n_ratings, k + 1).astype(np.int64)
+    return order, bounds
+
+
+def user_kfold(user, k, seed=0):
+    """
+    k-fold over users instead of ratings, all ratings of a user fall in the same fold
+    :return: order, bounds, same meaning as kfold
+    """
+    user = np.asarray(user)
+    fold_of_user = np.random.RandomState(seed).randint(0, k, size=user.max() + 1)
+    fold = fold_of_user[user]
+    order = np.argsort(fold, kind='stable')
+    bounds = np.searchsorted(fold[order], np.arange(k + 1))
+    return order, bounds
+
+
+def fold_indices(order, bounds, f):
+    """
+    :return: train_idx, test_idx of fold f, test_idx is a view of order
+    """
+    test_idx = order[bounds[f]:bounds[f + 1]]
+    train_idx = np.concatenate((order[:bounds[f]], order[bounds[f + 1]:]))
+    return train_idx, test_idx
+
+
+def reorder_columns(columns, order):
+    """
+    Copy the columns once in fold order, afterwards use fold_view for zero-copy folds
+    :param columns: dict of column name -> 1d ndarray (see ratings_loader)
+    """
+    return {name: np.ascontiguousarray(col[order]) for name, col in columns.items()}
+
+
+def fold_view(reordered, bounds, f):
+    """
+    :param reordered: output of reorder_columns
+    :return: train, test: train is a pair of views (before, after the fold), test is a view
+    """
+    lo, hi = bounds[f], bounds[f + 1]
+    test = {name: col[lo:hi] for name, col in reordered.items()}
+    train = ({name: col[:lo] for name, col in reordered.items()},
+             {name: col[hi:] for name, col in reordered.items()})
+    return train, test
+
+
+def take(ratings, idx):
+    """
+    :param ratings: matrix, row is (i, j, value, timestamp)
+    :return: [i, j, rating] rows of idx, like split_ratings outputs
+    """
+    return ratings[idx, :3]
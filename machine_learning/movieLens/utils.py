@@ -3,7 +3,7 @@ import os
 import pickle
 import sys
 from time import time
-from os.path import isfile
+from os.path import isfile, isdir
 
 import numpy as np
 import tqdm
@@ -13,6 +13,8 @@ from pyspark.mllib.recommendation import ALS, Rating, MatrixFactorizationModel
 from pyspark.sql import SparkSession
 from scipy.sparse import coo_matrix
 
+from machine_learning.movieLens.ratings_loader import load_ratings_columns, columns_to_array
+
 
 def parse_xoy(mat, n_users, n_items):
     """
@@ -63,11 +65,15 @@ def generate_xoy_binary(coo_mat, rating_shape):
     return x, o, y
 
 
-def load_ratings(ratings_file):
+def load_ratings(ratings_file, n_workers=None, check_crc=False):
     """
     Load ratings from file into ndarray
-    return: ndarray, [i, j, rating, timestamp]
+    ratings_file can also be a partitioned directory (e.g. data/movielens/large/ratings.dat), its parts are
+    parsed in parallel and cached as columns, see ratings_loader.load_ratings_columns
+    return: ndarray, [i, j, rating, timestamp], int like a single file, float64 if there are half-star ratings
     """
+    if isdir(ratings_file):
+        return columns_to_array(load_ratings_columns(ratings_file, n_workers=n_workers, check_crc=check_crc))
     if not isfile(ratings_file):
         print("File %s does not exist." % ratings_file)
         sys.exit(1)